@@ -0,0 +1,261 @@
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+"""
+    Helpers shared by the benchmarks: timing, allocation counting, baselines and the command line.
+    Run a benchmark from the root of the repository, e.g. "python -m benchmarks.packet_codec --save base.json" and
+    later "python -m benchmarks.packet_codec --compare base.json".
+
+"""
+
+# Ratio off the baseline which counts as a regression (0.15 -> 15% slower, bigger or less throughput).
+DEFAULT_THRESHOLD = 0.15
+
+# Metrics which are compared with the baseline -> whether higher values are better. The others (counts,
+# percentiles, retained bytes, ...) are only reported.
+COMPARED_METRICS = {
+    'ns_per_op': False,
+    'peak_bytes': False,
+    'seconds': False,
+    'cpu_seconds': False,
+    'deliveries_per_second': True,
+    'root_reunion_packets_per_second': True,
+}
+
+
+def measure(function, repeat=5, min_time=0.05):
+    """
+    Time a function without arguments.
+
+    The number of calls per round is doubled until a round takes min_time seconds; the fastest of 'repeat' rounds
+    is taken, because the slower ones are only slower by noise (other processes, the GC, ...).
+
+    :param function: The operation.
+    :param repeat: Number of rounds.
+    :param min_time: Minimum seconds of one round.
+
+    :type repeat: int
+    :type min_time: float
+
+    :return: Nanoseconds per call.
+    :rtype: float
+    """
+    number = 1
+    while True:
+        elapsed = _run(function, number)
+        if elapsed >= min_time * 1e9:
+            break
+        number *= 2
+    best = elapsed
+    for _ in range(repeat - 1):
+        best = min(best, _run(function, number))
+    return best / number
+
+
+def _run(function, number):
+    start = time.perf_counter_ns()
+    for _ in range(number):
+        function()
+    return time.perf_counter_ns() - start
+
+
+def allocations(function):
+    """
+    Memory one call of the function allocates, by tracemalloc; call it once before, so caches are already full.
+
+    :param function: The operation.
+
+    :return: (peak, retained): bytes in use at the peak of the call and bytes still in use after it (e.g. the
+             packet it returns).
+    :rtype: tuple
+    """
+    tracemalloc.start()
+    try:
+        result = function()
+        retained, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del result
+    return peak, retained
+
+
+def run_cases(cases, quick=False, out=sys.stdout):
+    """
+    Measure every case and print a line for each of them.
+
+    :param cases: [(name, function), ...]
+    :param quick: Shorter rounds; less exact but fast, e.g. for a smoke run.
+    :param out: Where the lines are printed.
+
+    :type cases: list
+    :type quick: bool
+
+    :return: name -> {'ns_per_op': ..., 'peak_bytes': ..., 'retained_bytes': ...}
+    :rtype: dict
+    """
+    results = {}
+    width = max(len(name) for name, _ in cases)
+    print('{:<{}}  {:>12}  {:>10}  {:>10}'.format('case', width, 'ns/op', 'peak B', 'kept B'), file=out)
+    for name, function in cases:
+        function()  # warm up
+        peak, retained = allocations(function)
+        if quick:
+            ns = measure(function, repeat=1, min_time=0.005)
+        else:
+            ns = measure(function)
+        results[name] = {'ns_per_op': ns, 'peak_bytes': peak, 'retained_bytes': retained}
+        print('{:<{}}  {:>12.1f}  {:>10}  {:>10}'.format(name, width, ns, peak, retained), file=out)
+    return results
+
+
+def latency_summary(samples):
+    """
+    Summary of the latencies of single calls, e.g. for operations whose cost depends on the state they run on.
+
+    :param samples: Nanoseconds of every call.
+    :type samples: list
+
+    :return: {'count': ..., 'ns_per_op': mean, 'p50_ns': ..., 'p90_ns': ..., 'p99_ns': ..., 'max_ns': ...}
+    :rtype: dict
+    """
+    samples = sorted(samples)
+    count = len(samples)
+    summary = {'count': count, 'ns_per_op': sum(samples) / count, 'max_ns': samples[-1]}
+    for point in (50, 90, 99):
+        # Nearest rank.
+        summary['p' + str(point) + '_ns'] = samples[max(0, -(-count * point // 100) - 1)]
+    return summary
+
+
+def save_baseline(path, results):
+    """
+    Save the results as JSON, with the interpreter and machine they were measured on.
+
+    :param path: JSON file.
+    :param results: Output of run_cases.
+
+    :return:
+    """
+    baseline = {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'machine': platform.machine(),
+        'platform': platform.platform(),
+        'results': results,
+    }
+    with open(path, 'w') as file:
+        json.dump(baseline, file, indent=2, sort_keys=True)
+
+
+def load_baseline(path):
+    """
+
+    :param path: JSON file made by save_baseline.
+
+    :return: name -> measurements, like run_cases returns.
+    :rtype: dict
+    """
+    with open(path) as file:
+        return json.load(file)['results']
+
+
+def compare(results, baseline, threshold=DEFAULT_THRESHOLD):
+    """
+    Find the cases whose COMPARED_METRICS are worse than the baseline by more than the threshold: higher for the
+    costs (time, memory), lower for the rates (throughput). Cases which are only in one of them are ignored.
+
+    :param results: Output of run_cases.
+    :param baseline: Output of load_baseline.
+    :param threshold: Allowed ratio over the baseline.
+
+    :type threshold: float
+
+    :return: [(name, metric, baseline value, new value), ...]
+    :rtype: list
+    """
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        for metric, higher_is_better in sorted(COMPARED_METRICS.items()):
+            if metric not in baseline[name] or metric not in results[name]:
+                continue
+            old = baseline[name][metric]
+            new = results[name][metric]
+            if new < old * (1 - threshold) if higher_is_better else new > old * (1 + threshold):
+                regressions.append((name, metric, old, new))
+    return regressions
+
+
+def parse_args(description, argv=None, add_arguments=None):
+    """
+    Parse the common options of the benchmarks.
+
+    :param description: What the benchmark measures.
+    :param argv: Arguments; sys.argv[1:] if it's None.
+    :param add_arguments: Function of (parser) which adds the options of the benchmark itself.
+
+    :return: The parsed options.
+    :rtype: argparse.Namespace
+    """
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--save', metavar='PATH', help='save the results as a baseline JSON file')
+    parser.add_argument('--compare', metavar='PATH', help='compare the results with a baseline JSON file')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='ratio over the baseline which counts as a regression (default %(default)s)')
+    parser.add_argument('--quick', action='store_true', help='short rounds and fewer cases, for a smoke run')
+    parser.add_argument('--filter', metavar='TEXT', help='only the cases whose name contains TEXT')
+    if add_arguments is not None:
+        add_arguments(parser)
+    return parser.parse_args(argv)
+
+
+def finish(args, results):
+    """
+    Save the results as a baseline and/or compare them with one, as the options say.
+
+    :param args: Output of parse_args.
+    :param results: name -> measurements; an optional 'config' entry holds the options the results depend on.
+
+    :return: The exit status: 1 if a regression was found, otherwise 0.
+    :rtype: int
+    """
+    if args.save:
+        save_baseline(args.save, results)
+    if args.compare:
+        baseline = load_baseline(args.compare)
+        if baseline.get('config') != results.get('config'):
+            print('WARNING: the baseline was measured with another configuration:', baseline.get('config'))
+        regressions = compare(results, baseline, args.threshold)
+        for name, metric, old, new in regressions:
+            change = '{:+.0%}'.format(new / old - 1) if old else 'new'
+            print('REGRESSION {} {}: {:.1f} -> {:.1f} ({})'.format(name, metric, old, new, change))
+        if regressions:
+            return 1
+        print('No regressions over {:.0%}'.format(args.threshold))
+    return 0
+
+
+def main(description, make_cases, argv=None):
+    """
+    Command line of a benchmark made of cases for run_cases: run it, then save a baseline and/or compare with one.
+
+    :param description: What the benchmark measures.
+    :param make_cases: Function of (args) which returns the cases for run_cases; args.quick is set for smoke runs.
+    :param argv: Arguments; sys.argv[1:] if it's None.
+
+    :return: The exit status: 1 if a regression was found, otherwise 0.
+    :rtype: int
+    """
+    args = parse_args(description, argv)
+    cases = make_cases(args)
+    if args.filter:
+        cases = [case for case in cases if args.filter in case[0]]
+    if not cases:
+        print('No cases to run', file=sys.stderr)
+        return 0
+    return finish(args, run_cases(cases, quick=args.quick))
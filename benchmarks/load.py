@@ -0,0 +1,324 @@
+import collections
+import multiprocessing
+import os
+import resource
+import sys
+import threading
+import time
+
+from src.Peer import Peer
+from src.RootCluster import RootCluster
+from src.tools import utils
+from benchmarks import harness
+
+"""
+    End-to-end load on localhost: a root and N peers, every one in its own process, on loopback ports.
+
+    1. join:       every peer sends Register and Advertise at the same time; the time until the last of them has got
+                   its parent, and until the root's graph holds all of them.
+    2. broadcast:  the root broadcasts messages (with their send time in them); the delivery latency on every peer,
+                   grouped by its depth in the tree, and the deliveries per second of the whole network.
+    3. heartbeat:  the Reunion Hellos run all the time, every --heartbeat-interval seconds; the Reunion packets the root
+                   handled per second and the nodes it still sees alive at the end.
+    At the end every process reports its CPU time and maximum RSS. Unix only (resource).
+    With --cluster the root is a RootCluster; its CPU time is the one of the owner, and the acceptors are reported
+    apart.
+
+    python -m benchmarks.load [--peers N] [--port PORT] [--messages N] [--size BYTES] [--rate N]
+                              [--heartbeat-interval SECONDS] [--packet-version 1|2] [--reunion-mode path|aggregate]
+                              [--cluster] [--acceptors N] [--save PATH] [--compare PATH] [--quick] [--verbose]
+
+"""
+
+IP = '127.000.000.001'
+
+# The text of every load message starts with this; then its number and its send time (time.time()).
+MESSAGE_PREFIX = 'load '
+
+# Seconds to wait for any step of a process before giving up.
+STEP_TIMEOUT = 60
+
+
+def _usage():
+    """
+
+    :return: (CPU seconds, maximum RSS in bytes) of this process.
+    :rtype: tuple
+    """
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    # ru_maxrss is in KiB on Linux but in bytes on macOS.
+    rss = usage.ru_maxrss if sys.platform == 'darwin' else usage.ru_maxrss * 1024
+    return usage.ru_utime + usage.ru_stime, rss
+
+
+def run_peer(options, port, connection):
+    """
+    The main function of a peer (or root) process: run a Peer and do what the harness asks on the connection.
+
+    :param options: The options of the run (see add_arguments).
+    :param port: Our port; the root has options.port.
+    :param connection: Our end of the pipe to the harness.
+
+    :type port: int
+    :type connection: multiprocessing.connection.Connection
+
+    :return:
+    """
+    if not options.verbose:
+        sys.stdout = open(os.devnull, 'w')
+        utils.DEBUG = False
+    is_root = port == options.port
+    cluster = None
+    if is_root and options.cluster:
+        cluster = RootCluster(IP, port, acceptors=options.acceptors, reunion_mode=options.reunion_mode,
+                              packet_version=options.packet_version, interactive=False)
+        peer = cluster.peer
+    else:
+        peer = Peer(IP, port, is_root=is_root, root_address=None if is_root else (IP, options.port),
+                    reunion_mode=options.reunion_mode, packet_version=options.packet_version, interactive=False)
+    peer.reunion_interval = options.heartbeat_interval
+
+    # Packets we have handled by their type.
+    packets = collections.Counter()
+    handle_packet = peer.handle_packet
+
+    def counting_handle_packet(packet):
+        packets[packet.get_type()] += 1
+        handle_packet(packet)
+
+    peer.handle_packet = counting_handle_packet
+
+    # (send time, receive time) of every load message.
+    deliveries = []
+
+    def on_message(message_id, message):
+        received = time.time()
+        if message.startswith(MESSAGE_PREFIX):
+            deliveries.append((float(message.split(' ', 3)[2]), received))
+
+    peer.on_message = on_message
+    threading.Thread(target=peer.run, daemon=True).start()
+    connection.send(peer.address)
+
+    while True:
+        command, argument = connection.recv()
+        if command == 'join':
+            peer.register()
+            peer.advertise()
+            deadline = time.time() + STEP_TIMEOUT
+            while peer.parent_address == (None, None) and time.time() < deadline:
+                time.sleep(0.001)
+            connection.send(time.time() if peer.parent_address != (None, None) else None)
+        elif command == 'depths':
+            with peer._state_lock:
+                connection.send({address: node.depth for address, node in peer.networkGraph.nodes.items()
+                                 if node.alive})
+        elif command == 'broadcast':
+            count, size, rate = argument
+            start = time.time()
+            for i in range(count):
+                if rate:
+                    delay = start + i / rate - time.time()
+                    if delay > 0:
+                        time.sleep(delay)
+                header = MESSAGE_PREFIX + str(i) + ' ' + repr(time.time()) + ' '
+                peer.send_message(header + 'x' * max(0, size - len(header)))
+            connection.send(None)
+        elif command == 'received':
+            connection.send(len(deliveries))
+        elif command == 'report':
+            cpu, rss = _usage()
+            report = {
+                'address': peer.address,
+                'cpu_seconds': cpu,
+                'rss_bytes': rss,
+                'deliveries': deliveries,
+                'packets': dict(packets),
+                'alive': len(peer.last_hello_times) if is_root else None,
+            }
+            if cluster is not None:
+                # The acceptors are counted in RUSAGE_CHILDREN once they are stopped; this is the last step.
+                cluster.close()
+                usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+                report['acceptors_cpu_seconds'] = usage.ru_utime + usage.ru_stime
+            connection.send(report)
+        elif command == 'stop':
+            if cluster is not None:
+                cluster.close()
+            connection.send(None)
+            connection.close()
+            # The Peer threads never end by themselves.
+            os._exit(0)
+
+
+class Process:
+    def __init__(self, options, port):
+        """
+        A peer process and our end of its pipe.
+
+        :param options: The options of the run.
+        :param port: Port of the peer.
+        """
+        self.connection, child_connection = multiprocessing.Pipe()
+        # A daemon process can't start the acceptor processes of a RootCluster.
+        daemon = not (options.cluster and port == options.port)
+        self.process = multiprocessing.Process(target=run_peer, args=(options, port, child_connection),
+                                               name='peer-' + str(port), daemon=daemon)
+        self.process.start()
+        child_connection.close()
+        self.address = None
+
+    def send(self, command, argument=None):
+        self.connection.send((command, argument))
+
+    def receive(self):
+        """
+
+        :return: The answer of the peer to the last command.
+        """
+        if not self.connection.poll(STEP_TIMEOUT):
+            raise TimeoutError(self.process.name + ' did not answer in ' + str(STEP_TIMEOUT) + ' seconds')
+        return self.connection.recv()
+
+    def ask(self, command, argument=None):
+        self.send(command, argument)
+        return self.receive()
+
+    def stop(self):
+        try:
+            self.ask('stop')
+        except (OSError, EOFError, TimeoutError):
+            self.process.terminate()
+        self.process.join(5)
+
+
+def add_arguments(parser):
+    parser.add_argument('--peers', type=int, default=30, help='number of peers besides the root (default %(default)s)')
+    parser.add_argument('--port', type=int, default=31000,
+                        help='port of the root; the peers take the ports after it (default %(default)s)')
+    parser.add_argument('--messages', type=int, default=500,
+                        help='messages the root broadcasts (default %(default)s)')
+    parser.add_argument('--size', type=int, default=256, help='bytes of every message (default %(default)s)')
+    parser.add_argument('--rate', type=float, default=0,
+                        help='messages per second the root sends; 0 sends them as fast as it can (default %(default)s)')
+    parser.add_argument('--heartbeat-interval', type=float, default=1.0,
+                        help='seconds between the Reunion Hellos of every peer (default %(default)s)')
+    parser.add_argument('--packet-version', type=int, default=1, choices=(1, 2))
+    parser.add_argument('--reunion-mode', default='path', choices=('path', 'aggregate'))
+    parser.add_argument('--cluster', action='store_true', help='run the root as a RootCluster')
+    parser.add_argument('--acceptors', type=int, default=None,
+                        help='acceptor processes of the RootCluster (default: the number of CPU cores)')
+    parser.add_argument('--verbose', action='store_true', help='keep the output of the peers')
+
+
+def _wait_until(check, timeout=STEP_TIMEOUT, interval=0.05):
+    deadline = time.time() + timeout
+    while not check():
+        if time.time() > deadline:
+            return False
+        time.sleep(interval)
+    return True
+
+
+def run(args):
+    """
+
+    :return: name -> measurements.
+    :rtype: dict
+    """
+    if args.peers < 1:
+        raise ValueError('The load needs at least one peer')
+    if args.quick:
+        args.peers = min(args.peers, 7)
+        args.messages = min(args.messages, 50)
+    # Results of different loads can't be compared; see harness.finish.
+    results = {'config': {name: getattr(args, name) for name in ('peers', 'messages', 'size', 'rate',
+                                                                  'heartbeat_interval', 'packet_version',
+                                                                  'reunion_mode', 'cluster', 'acceptors')}}
+    root = Process(args, args.port)
+    root.address = root.receive()
+    peers = [Process(args, args.port + 1 + i) for i in range(args.peers)]
+    processes = [root] + peers
+    try:
+        for peer in peers:
+            peer.address = peer.receive()
+
+        # 1. join
+        start = time.time()
+        for peer in peers:
+            peer.send('join')
+        joined = [peer.receive() for peer in peers]
+        if None in joined:
+            raise RuntimeError(str(joined.count(None)) + ' peers could not join the network')
+        if not _wait_until(lambda: len(root.ask('depths')) == args.peers + 1):
+            raise RuntimeError('The graph of the root does not hold every peer')
+        in_graph = time.time()
+        join_times = [(moment - start) * 1e9 for moment in joined]
+        results['join'] = harness.latency_summary(join_times)
+        results['join/graph'] = {'ns_per_op': (in_graph - start) * 1e9}
+        print('{} peers joined in {:.3f} s (p50 {:.3f} s), all in the graph of the root after {:.3f} s'.format(
+            args.peers, max(joined) - start, results['join']['p50_ns'] / 1e9, in_graph - start))
+        # Let the Join packets reach the parents before the first broadcast.
+        time.sleep(0.5)
+        depths = root.ask('depths')
+
+        # 2. broadcast
+        root.ask('broadcast', (args.messages, args.size, args.rate))
+        if not _wait_until(lambda: all(peer.ask('received') >= args.messages for peer in peers)):
+            print('Not every message was delivered in {} seconds'.format(STEP_TIMEOUT))
+
+        # 3. heartbeat: it has been running since the peers joined; give it at least three intervals.
+        time.sleep(max(0.0, start + 3 * args.heartbeat_interval - time.time()))
+
+        reports = [process.ask('report') for process in processes]
+        elapsed = time.time() - start
+    finally:
+        for process in processes:
+            process.stop()
+
+    by_depth = collections.defaultdict(list)
+    first_sent, last_received, delivered = None, None, 0
+    for report in reports[1:]:
+        depth = depths.get(report['address'])
+        for sent, received in report['deliveries']:
+            by_depth[depth].append((received - sent) * 1e9)
+            first_sent = sent if first_sent is None else min(first_sent, sent)
+            last_received = received if last_received is None else max(last_received, received)
+            delivered += 1
+    expected = args.messages * args.peers
+    throughput = delivered / (last_received - first_sent) if delivered and last_received > first_sent else 0.0
+    results['broadcast'] = {'delivered': delivered, 'expected': expected, 'deliveries_per_second': throughput}
+    print('{} of {} deliveries, {:.0f} deliveries/s'.format(delivered, expected, throughput))
+    print('{:<10}  {:>8}  {:>10}  {:>10}  {:>10}  {:>10}'.format('depth', 'count', 'p50 ms', 'p90 ms', 'p99 ms',
+                                                                 'max ms'))
+    for depth in sorted(by_depth, key=lambda d: -1 if d is None else d):
+        summary = harness.latency_summary(by_depth[depth])
+        results['broadcast/depth-' + str(depth)] = summary
+        print('{:<10}  {:>8}  {:>10.2f}  {:>10.2f}  {:>10.2f}  {:>10.2f}'.format(
+            str(depth), summary['count'], summary['p50_ns'] / 1e6, summary['p90_ns'] / 1e6, summary['p99_ns'] / 1e6,
+            summary['max_ns'] / 1e6))
+
+    root_report = reports[0]
+    reunions = root_report['packets'].get(5, 0)
+    results['heartbeat'] = {'root_reunion_packets_per_second': reunions / elapsed, 'alive': root_report['alive']}
+    print('root handled {:.1f} Reunion packets/s; {} of {} peers alive at the root'.format(
+        reunions / elapsed, root_report['alive'], args.peers))
+
+    peer_cpu = [report['cpu_seconds'] for report in reports[1:]]
+    peer_rss = [report['rss_bytes'] for report in reports[1:]]
+    results['root/resources'] = {'cpu_seconds': root_report['cpu_seconds'], 'peak_bytes': root_report['rss_bytes']}
+    results['peer/resources'] = {'cpu_seconds': sum(peer_cpu) / len(peer_cpu), 'peak_bytes': max(peer_rss)}
+    print('{:<10}  {:>10}  {:>10}'.format('', 'CPU s', 'RSS MiB'))
+    print('{:<10}  {:>10.2f}  {:>10.1f}'.format('root', root_report['cpu_seconds'], root_report['rss_bytes'] / 2 ** 20))
+    if 'acceptors_cpu_seconds' in root_report:
+        results['root/acceptors'] = {'cpu_seconds': root_report['acceptors_cpu_seconds']}
+        print('{:<10}  {:>10.2f}  {:>10}'.format('acceptors', root_report['acceptors_cpu_seconds'], '-'))
+    print('{:<10}  {:>10.2f}  {:>10.1f}'.format('peer mean', sum(peer_cpu) / len(peer_cpu),
+                                                sum(peer_rss) / len(peer_rss) / 2 ** 20))
+    print('{:<10}  {:>10.2f}  {:>10.1f}'.format('peer max', max(peer_cpu), max(peer_rss) / 2 ** 20))
+    return results
+
+
+if __name__ == '__main__':
+    arguments = harness.parse_args('End-to-end load on localhost', add_arguments=add_arguments)
+    sys.exit(harness.finish(arguments, run(arguments)))
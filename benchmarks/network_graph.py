@@ -0,0 +1,242 @@
+import random
+import sys
+import time
+import tracemalloc
+
+from src.tools.NetworkGraph import NetworkGraph, GraphNode
+from src.tools.DeadlineHeap import DeadlineHeap
+from benchmarks import harness
+
+"""
+    How the NetworkGraph of the root scales with the number of nodes.
+
+    For every size and shape a synthetic tree is built by joins, then these workloads are replayed on it:
+        join:           find_live_node and add_node of a new node (only the 'balanced' shape asks find_live_node).
+        find_node:      lookups of random nodes.
+        heartbeat:      what the root does for a Reunion Hello: move the deadline, find_node, turn_on_node.
+        readvertise:    find_live_node for a node which is already in the graph (its sub-tree is skipped).
+        fail:           a node times out: turn_off_subtree and remove_node; then its children join again with
+                        their sub-trees (rejoin) and it joins again as a new node.
+        fail_top:       the same for a child of the root, i.e. about half of the network.
+    Latencies are of single calls (p50/p90/p99/max); memory is what tracemalloc sees while the tree is built.
+
+    python -m benchmarks.network_graph [--sizes 1000,10000,100000,1000000] [--shapes balanced,random,chain]
+                                       [--samples N] [--failures N] [--save PATH] [--compare PATH] [--quick]
+
+"""
+
+SHAPES = ('balanced', 'random', 'chain')
+ROOT_ADDRESS = ('010.255.255.255', '05335')
+
+# A chain of N nodes keeps a path of every depth up to N, so it needs O(N^2) memory; larger chains are skipped.
+MAX_CHAIN = 10000
+
+
+def node_address(i):
+    """
+
+    :param i: Number of the node.
+
+    :return: A unique address in the standard format for every i < 2^24.
+    :rtype: tuple
+    """
+    return '010.{:03d}.{:03d}.{:03d}'.format(i >> 16 & 255, i >> 8 & 255, i & 255), '05335'
+
+
+def build(size, shape, rng, samples=None):
+    """
+    Make a graph of size nodes besides the root.
+
+    :param size: Number of nodes.
+    :param shape: 'balanced': every node joins where the root sends it (a complete binary tree);
+                  'random': under a random node already in the graph; 'chain': under the last node.
+    :param rng: Random numbers of the 'random' shape.
+    :param samples: If it's given, the latencies (ns) of every call are added to samples['find_live_node'] and
+                    samples['add_node'].
+
+    :type size: int
+    :type shape: str
+    :type rng: random.Random
+    :type samples: dict
+
+    :return: The graph and the addresses of its nodes in the order they joined.
+    :rtype: tuple
+    """
+    clock = time.perf_counter_ns
+    graph = NetworkGraph(GraphNode(ROOT_ADDRESS))
+    addresses = [ROOT_ADDRESS]
+    for i in range(size):
+        address = node_address(i)
+        start = clock()
+        if shape == 'balanced':
+            father = graph.find_live_node(address).address
+        elif shape == 'random':
+            father = addresses[rng.randrange(len(addresses))]
+        else:
+            father = addresses[-1]
+        middle = clock()
+        graph.add_node(address[0], address[1], father)
+        end = clock()
+        if samples is not None:
+            if shape == 'balanced':
+                samples['find_live_node'].append(middle - start)
+            samples['add_node'].append(end - middle)
+        addresses.append(address)
+    return graph, addresses
+
+
+def build_memory(size, shape, seed):
+    """
+
+    :return: (peak, retained): bytes in use at the peak of building the graph and after it.
+    :rtype: tuple
+    """
+    tracemalloc.start()
+    try:
+        graph, addresses = build(size, shape, random.Random(seed))
+        del addresses
+        retained, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del graph
+    return peak, retained
+
+
+def replay(graph, addresses, rng, samples, count, failures):
+    """
+    Replay the workloads after the build on the graph.
+
+    :param graph: The graph.
+    :param addresses: Addresses of its nodes; the failed nodes join again, so it stays valid.
+    :param rng: Random numbers for picking the nodes.
+    :param samples: Name of the workload -> list of latencies (ns) to add to.
+    :param count: Calls of find_node, heartbeat and readvertise.
+    :param failures: Number of failures of random nodes.
+
+    :type graph: NetworkGraph
+    :type addresses: list
+    :type rng: random.Random
+    :type samples: dict
+    :type count: int
+    :type failures: int
+
+    :return:
+    """
+    clock = time.perf_counter_ns
+    picks = [addresses[rng.randrange(1, len(addresses))] for _ in range(count)]
+
+    for address in picks:
+        start = clock()
+        graph.find_node(address[0], address[1])
+        samples['find_node'].append(clock() - start)
+
+    deadlines = DeadlineHeap()
+    now = time.monotonic()
+    for address in picks:
+        start = clock()
+        deadlines.schedule(address, now + 16)
+        if graph.find_node(address[0], address[1]) is not None:
+            graph.turn_on_node(address)
+        samples['heartbeat'].append(clock() - start)
+
+    for address in picks:
+        start = clock()
+        graph.find_live_node(address)
+        samples['readvertise'].append(clock() - start)
+
+    for _ in range(failures):
+        fail(graph, addresses[rng.randrange(1, len(addresses))], samples, 'fail')
+    if len(graph.root.children) > 0:
+        fail(graph, graph.root.children[0].address, samples, 'fail_top')
+
+
+def fail(graph, address, samples, name):
+    """
+    The node at address times out: turn off and remove it, then its children and itself join again, like the root
+    and the nodes do after a Reunion failure.
+
+    :return:
+    """
+    clock = time.perf_counter_ns
+    node = graph.find_node(address[0], address[1])
+    orphans = [child.address for child in node.children]
+    start = clock()
+    graph.turn_off_subtree(address)
+    graph.remove_node(address)
+    samples[name].append(clock() - start)
+    for orphan in orphans + [address]:
+        start = clock()
+        father = graph.find_live_node(orphan)
+        graph.add_node(orphan[0], orphan[1], father.address)
+        samples['rejoin'].append(clock() - start)
+
+
+def add_arguments(parser):
+    parser.add_argument('--sizes', default='1000,10000,100000,1000000',
+                        help='comma separated numbers of nodes (default %(default)s)')
+    parser.add_argument('--shapes', default=','.join(SHAPES),
+                        help='comma separated shapes of the trees (default %(default)s)')
+    parser.add_argument('--samples', type=int, default=10000,
+                        help='calls of find_node, heartbeat and readvertise per graph (default %(default)s)')
+    parser.add_argument('--failures', type=int, default=200,
+                        help='failures of random nodes per graph (default %(default)s)')
+    parser.add_argument('--seed', type=int, default=5335, help='seed of the random numbers (default %(default)s)')
+    parser.add_argument('--no-memory', action='store_true',
+                        help="don't build every graph again under tracemalloc (which is slow for big graphs)")
+
+
+def run(args):
+    """
+
+    :return: name -> measurements; for every graph a '.../build' entry with its memory and an entry for every
+             workload with its latencies.
+    :rtype: dict
+    """
+    sizes = [int(size) for size in args.sizes.split(',')]
+    shapes = args.shapes.split(',')
+    count, failures = args.samples, args.failures
+    if args.quick:
+        sizes = [size for size in sizes if size <= 10000]
+        count, failures = min(count, 1000), min(failures, 20)
+    results = {}
+    print('{:<32}  {:>8}  {:>10}  {:>10}  {:>10}  {:>10}  {:>12}'.format(
+        'case', 'count', 'mean ns', 'p50 ns', 'p99 ns', 'max ns', 'bytes/node'))
+    for size in sizes:
+        for shape in shapes:
+            if shape not in SHAPES:
+                raise ValueError('Unknown shape: ' + shape)
+            prefix = str(size) + '/' + shape
+            if args.filter and args.filter not in prefix:
+                continue
+            if shape == 'chain' and size > MAX_CHAIN:
+                print('{:<32}  skipped: a chain needs O(n^2) memory'.format(prefix))
+                continue
+            samples = {name: [] for name in ('find_live_node', 'add_node', 'find_node', 'heartbeat', 'readvertise',
+                                             'fail', 'fail_top', 'rejoin')}
+            rng = random.Random(args.seed)
+            start = time.perf_counter()
+            graph, addresses = build(size, shape, rng, samples)
+            build_seconds = time.perf_counter() - start
+            replay(graph, addresses, rng, samples, min(count, size), min(failures, size))
+            del graph, addresses
+            build_result = {'seconds': build_seconds}
+            if not args.no_memory:
+                build_result['peak_bytes'], build_result['retained_bytes'] = build_memory(size, shape, args.seed)
+            results[prefix + '/build'] = build_result
+            print('{:<32}  {:>8}  {:>10}  {:>10}  {:>10}  {:>10}  {:>12}'.format(
+                prefix + '/build', size, '{:.2f} s'.format(build_seconds), '', '', '',
+                '{:.0f}'.format(build_result['retained_bytes'] / size) if 'retained_bytes' in build_result else '-'))
+            for name, values in samples.items():
+                if not values:
+                    continue
+                summary = harness.latency_summary(values)
+                results[prefix + '/' + name] = summary
+                print('{:<32}  {:>8}  {:>10.0f}  {:>10}  {:>10}  {:>10}'.format(
+                    prefix + '/' + name, summary['count'], summary['ns_per_op'], summary['p50_ns'],
+                    summary['p99_ns'], summary['max_ns']))
+    return results
+
+
+if __name__ == '__main__':
+    arguments = harness.parse_args('NetworkGraph scaling benchmark', add_arguments=add_arguments)
+    sys.exit(harness.finish(arguments, run(arguments)))
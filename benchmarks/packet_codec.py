@@ -0,0 +1,145 @@
+import os
+import sys
+
+from src.Packet import PacketFactory, MAX_REUNION_ENTRIES
+from src.tools import utils
+from benchmarks import harness
+
+"""
+    Encode/decode cost of every packet type, in both packet versions.
+
+    encode: the PacketFactory constructor and get_buf.
+    decode: Packet.__init__ (parse_buffer) and the getters the Peer calls for that type.
+    parse: Packet.__init__ alone.
+
+    python -m benchmarks.packet_codec [--save PATH] [--compare PATH] [--threshold RATIO] [--quick] [--filter TEXT]
+
+"""
+
+SOURCE = ('192.168.001.001', '05335')
+OTHER = ('010.000.000.042', '12345')
+
+# Bytes of the Message bodies and of the Blob chunks.
+MESSAGE_SIZES = (16, 256, 4096, 65536)
+BLOB_SIZES = (1024, 65536)
+
+# Compression is measured on this many bytes of text, which compresses like a typical JSON message.
+COMPRESSED_SIZE = 65536
+
+
+def _addresses(count):
+    return [('10.{:03d}.{:03d}.001'.format(i // 250, i % 250), '{:05d}'.format(20000 + i)) for i in range(count)]
+
+
+def _reunion_counts(version):
+    counts = [1, 8, 32, MAX_REUNION_ENTRIES[version]]
+    return sorted(set(counts))
+
+
+def _codec_cases(name, encode, decode):
+    """
+
+    :param name: Name of the packet, like 'v1/message/256'.
+    :param encode: Function which makes the packet.
+    :param decode: Function of a Packet which reads what the Peer reads of it.
+
+    :return: The encode, decode and parse cases of the packet.
+    :rtype: list
+    """
+    buf = encode().get_buf()
+    return [
+        (name + '/encode', lambda: encode().get_buf()),
+        (name + '/decode', lambda: decode(PacketFactory.parse_buffer(buf))),
+        (name + '/parse', lambda: PacketFactory.parse_buffer(buf)),
+    ]
+
+
+def packet_cases(version, quick=False):
+    """
+
+    :param version: Packet version.
+    :param quick: Only the smallest and the largest sizes.
+
+    :return: The cases of every packet type in the version.
+    :rtype: list
+    """
+    prefix = 'v' + str(version) + '/'
+    cases = []
+
+    cases += _codec_cases(prefix + 'register/req',
+                          lambda: PacketFactory.new_register_packet('REQ', SOURCE, SOURCE, version=version),
+                          lambda p: (p.get_source_server_address(), p.get_body_type(), p.get_body_address()))
+    cases += _codec_cases(prefix + 'register/res',
+                          lambda: PacketFactory.new_register_packet('RES', SOURCE, version=version),
+                          lambda p: (p.get_source_server_address(), p.get_body_type(), p.get_body_type(6)))
+    cases += _codec_cases(prefix + 'advertise/req',
+                          lambda: PacketFactory.new_advertise_packet('REQ', SOURCE, version=version),
+                          lambda p: (p.get_source_server_address(), p.get_body_type()))
+    cases += _codec_cases(prefix + 'advertise/res',
+                          lambda: PacketFactory.new_advertise_packet('RES', SOURCE, OTHER, version=version),
+                          lambda p: (p.get_source_server_address(), p.get_body_type(), p.get_body_address()))
+    cases += _codec_cases(prefix + 'join',
+                          lambda: PacketFactory.new_join_packet(SOURCE, version=version),
+                          lambda p: (p.get_source_server_address(), p.get_body_type(4)))
+
+    counts = _reunion_counts(version)
+    if quick:
+        counts = [counts[0], counts[-1]]
+    for count in counts:
+        entries = _addresses(count)
+        cases += _codec_cases(prefix + 'reunion/' + str(count),
+                              lambda entries=entries: PacketFactory.new_reunion_packet('REQ', SOURCE, entries,
+                                                                                       version=version),
+                              lambda p: (p.get_source_server_address(), p.get_body_type(), p.get_reunion_entries()))
+
+    sizes = (MESSAGE_SIZES[0], MESSAGE_SIZES[-1]) if quick else MESSAGE_SIZES
+    for size in sizes:
+        message = 'x' * size
+        cases += _codec_cases(prefix + 'message/' + str(size),
+                              lambda message=message: PacketFactory.new_message_packet(message, SOURCE, (OTHER, 7),
+                                                                                        version=version),
+                              lambda p: (p.get_source_server_address(), p.get_message_id(), p.get_message()))
+        # What every relaying peer does with it.
+        packet = PacketFactory.new_message_packet(message, SOURCE, (OTHER, 7), version=version)
+        cases.append((prefix + 'message/' + str(size) + '/relay',
+                      lambda packet=packet: PacketFactory.relay_packet(packet, OTHER).get_buf()))
+
+    text = ('{"id": 1, "name": "peer", "tags": ["a", "b"]}, ' * (COMPRESSED_SIZE // 48 + 1))[:COMPRESSED_SIZE]
+    cases += _codec_cases(prefix + 'message/' + str(COMPRESSED_SIZE) + '/compressed',
+                          lambda: PacketFactory.new_message_packet(text, SOURCE, (OTHER, 7), version=version,
+                                                                   compress_threshold=1024),
+                          lambda p: (p.get_source_server_address(), p.get_message_id(), p.get_message()))
+
+    sizes = BLOB_SIZES[-1:] if quick else BLOB_SIZES
+    for size in sizes:
+        data = os.urandom(size)
+        cases += _codec_cases(prefix + 'blob/' + str(size),
+                              lambda data=data: PacketFactory.new_blob_packet((OTHER, 7), 3, 100, data, SOURCE,
+                                                                              version=version),
+                              lambda p: (p.get_source_server_address(), p.get_blob_chunk()))
+    return cases
+
+
+def utils_cases():
+    """
+
+    :return: The cases of the byte helpers in src.tools.utils.
+    :rtype: list
+    """
+    ip_bytes = utils.ip_to_bytes(SOURCE[0])
+    return [
+        ('utils/int_to_bytes', lambda: utils.int_to_bytes(5335, 4)),
+        ('utils/ip_to_bytes', lambda: utils.ip_to_bytes(SOURCE[0])),
+        ('utils/bytes_to_ip', lambda: utils.bytes_to_ip(ip_bytes)),
+    ]
+
+
+def make_cases(args):
+    cases = []
+    for version in (1, 2):
+        cases += packet_cases(version, args.quick)
+    return cases + utils_cases()
+
+
+if __name__ == '__main__':
+    sys.exit(harness.main('Packet codec microbenchmarks', make_cases))
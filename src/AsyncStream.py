@@ -0,0 +1,154 @@
+import asyncio
+import threading
+
+from src.Stream import Stream
+from src.tools.simpletcp.framedecoder import FrameTooLarge
+from src.tools.AsyncNode import AsyncNode
+
+
+class ServerProtocol(asyncio.Protocol):
+    def __init__(self, stream):
+        """
+        asyncio protocol for the connections accepted by an AsyncStream server.
+
+        It also acts as the response queue that the Stream callback puts its responses in.
+
+        :param stream: The stream that accepted this connection.
+        :type stream: AsyncStream
+        """
+        self.stream = stream
+        self.decoder = stream.new_frame_decoder()
+        self.transport = None
+        self.address = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.address = transport.get_extra_info('peername')
+
+    def data_received(self, data):
+        try:
+            frames = self.decoder.feed(data)
+        except FrameTooLarge:
+            # Don't buffer it; the sender is broken or hostile.
+            self.transport.close()
+            return
+        for frame in frames:
+            self.stream.callback(self.address, self, frame)
+        if frames:
+            self.stream.notify()
+            # One read can complete many frames, so the input buffer may go over its capacity by one read.
+            if self.stream.inbound_full():
+                self.stream.pause_reading(self.transport)
+
+    def put(self, data):
+        self.transport.write(data)
+
+
+class AsyncStream(Stream):
+    """
+    Stream which does all of its network I/O on an asyncio event loop, without any thread.
+
+    Code design suggestion:
+        1. Make it in the thread of the event loop and await 'start' before using it.
+    """
+    node_class = AsyncNode
+
+    def start_server(self, ip, port, callback):
+        """
+        Only save the server address; the server starts listening in 'start'.
+
+        :param ip: 15 characters
+        :param port: 5 characters
+        :param callback: The function to call for every packet received by the server.
+
+        :return:
+        """
+        self.ip = ip
+        self.port = int(port)
+        self.callback = callback
+        self.server = None
+        self.loop = None
+        self._loop_thread_id = None
+        # Transports which stopped reading because the input buffer is full.
+        self._paused_transports = set()
+
+    async def start(self):
+        """
+        Start listening on our server address, if we are not listening yet.
+
+        :return:
+        """
+        if self.server is None:
+            self.loop = asyncio.get_event_loop()
+            self._loop_thread_id = threading.get_ident()
+            self._wakeup = asyncio.Event()
+            self.server = await self.loop.create_server(lambda: ServerProtocol(self), self.ip, self.port, backlog=256)
+
+    def pause_reading(self, transport):
+        """
+        Stop reading from the transport until the input buffer is drained.
+
+        :param transport: Transport of a connection to our server.
+
+        :return:
+        """
+        transport.pause_reading()
+        self._paused_transports.add(transport)
+
+    def drain_in_buf(self, max_packets=None):
+        """
+        Take the packets in the input buffer, and start reading from the paused connections again if there is room.
+
+        :param max_packets: Maximum number of packets to take; None takes all of them.
+        :type max_packets: int
+
+        :return: Received packets in their arrival order.
+        :rtype: list
+        """
+        packets = super().drain_in_buf(max_packets)
+        if self._paused_transports and not self.inbound_full():
+            for transport in self._paused_transports:
+                if not transport.is_closing():
+                    transport.resume_reading()
+            self._paused_transports.clear()
+        return packets
+
+    def notify(self):
+        """
+        Wake up whoever awaits 'wait'; it can be called from any thread.
+
+        :return:
+        """
+        if self.loop is None:
+            return  # not started yet; 'wait' can't be awaited before 'start' either
+        if threading.get_ident() == self._loop_thread_id:
+            self._wakeup.set()
+        else:
+            self.loop.call_soon_threadsafe(self._wakeup.set)
+
+    async def wait(self, timeout=None):
+        """
+        Wait until 'notify' is called or timeout seconds have passed.
+
+        :param timeout: Maximum time to wait in seconds; None waits forever.
+        :type timeout: float
+
+        :return:
+        """
+        if self._wakeup.is_set():
+            # Event.wait wouldn't yield then, and the transports need the loop to write.
+            await asyncio.sleep(0)
+        else:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        self._wakeup.clear()
+
+    def get_server_address(self):
+        """
+
+        :return: Our server address
+        :rtype: tuple
+        """
+        return self.ip, self.port
@@ -1,9 +1,31 @@
 from src.Peer import Peer
+from src.RootCluster import RootCluster
+import asyncio
+import sys
 import threading
-if __name__ == "__main__":
-    server = Peer("127.000.000.001", 3652, is_root=True)
-    threading.Thread(target=server.run).start()
 
+
+async def run_async():
+    # The event loop has one reader for stdin, so only the client reads the commands.
+    server = Peer("127.000.000.001", 3652, is_root=True, use_asyncio=True, interactive=False)
+    # The root must be listening before the client connects to it.
+    await server.stream.start()
     client = Peer("127.000.000.001", 35315, is_root=False,
-                  root_address=("127.000.000.001", 3652))
-    threading.Thread(target=client.run).start()
+                  root_address=("127.000.000.001", 3652), use_asyncio=True)
+    await asyncio.gather(server.run_async(), client.run_async())
+
+
+if __name__ == "__main__":
+    if '--asyncio' in sys.argv:
+        asyncio.run(run_async())
+    else:
+        if '--cluster' in sys.argv:
+            # Acceptor processes on every core in front of the root.
+            server = RootCluster("127.000.000.001", 3652)
+        else:
+            server = Peer("127.000.000.001", 3652, is_root=True)
+        threading.Thread(target=server.run).start()
+
+        client = Peer("127.000.000.001", 35315, is_root=False,
+                      root_address=("127.000.000.001", 3652))
+        threading.Thread(target=client.run).start()
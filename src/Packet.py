@@ -18,7 +18,8 @@
     |__________________________________________________________________________________________________________________|
 
     Version:
-        For now version is 1
+        1: The format described here.
+        2: The same fields, but the addresses are binary; see 'Version 2' below.
     
     Type:
         1: Register
@@ -26,7 +27,11 @@
         3: Join
         4: Message
         5: Reunion
+        6: Blob
                 e.g: type = '2' => Advertise packet.
+        The first byte of this field holds flags and the second byte the type:
+        0x01: Message ID; the body of the Message packet starts with its ID.
+        0x02: Compressed; the message (after the ID, if any) is compressed with zlib.
     Length:
         This field shows the character numbers for Body of the packet.
 
@@ -120,6 +125,24 @@
                 |________________________________________________|
 
             The message that want to broadcast to hole network. Right now this type only includes a plain text.
+
+            With the Message ID flag:
+                                ** Body Format **
+                 ________________________________________________
+                |              Origin IP (15 Chars)              |
+                |------------------------------------------------|
+                |             Origin Port (5 Chars)              |
+                |------------------------------------------------|
+                |            Sequence Number (10 Chars)          |
+                |------------------------------------------------|
+                |    Message (#Length - 30 Chars)                |
+                |________________________________________________|
+
+            The origin peer and its own counter make an ID which stays the same on every hop, so peers can drop
+            the messages they have already seen.
+
+            With the Compressed flag the message part is deflated (zlib); the ID stays as it is. Relays forward the
+            body without inflating it, only the peers that deliver the message inflate it.
         
         Reunion:
             Hello:
@@ -174,13 +197,217 @@
 
                 Root in an answer to the Reunion Hello message will send this packet to the target node.
                 In this packet, all the nodes (IP, port) exist in order by path traversal to target.
-            
-    
+
+            Aggregated Hello / Aggregated Hello Back:
+
+                                ** Body Format **
+                 ________________________________________________
+                |              AGG / AGB (3 Chars)               |
+                |------------------------------------------------|
+                |           Number of Entries (2 Chars)          |
+                |------------------------------------------------|
+                |                 IP0 (15 Chars)                 |
+                |------------------------------------------------|
+                |                Port0 (5 Chars)                 |
+                |------------------------------------------------|
+                |                     ...                        |
+                |________________________________________________|
+
+                In the 'aggregate' reunion mode, every interval each peer sends one AGG packet to its parent with its
+                own address and all of the addresses in the AGG packets its children sent since the last interval.
+                The root answers every AGG packet with one AGB packet holding the same addresses; every parent sends
+                each child an AGB packet with the addresses that came from that child.
+                More than 99 entries are split into several packets.
+
+        Blob:
+                                ** Body Format **
+                 ________________________________________________
+                |    Transfer ID (30 Chars, like a Message ID)   |
+                |------------------------------------------------|
+                |              Chunk Index (4 Bytes)             |
+                |------------------------------------------------|
+                |              Chunk Count (4 Bytes)             |
+                |------------------------------------------------|
+                |       Chunk Hash (16 Bytes, BLAKE2b of Data)   |
+                |------------------------------------------------|
+                |       Data (#Length - 54 Bytes)                |
+                |________________________________________________|
+
+            A file is broadcast as a blob of Chunk Count chunks (see tools/BlobTransfer). Every chunk is forwarded
+            as soon as it arrives and its hash is checked, so a hop never waits for the whole blob.
+
+
+    Version 2:
+
+                                        ** Header Format **
+         __________________________________________________________________________________________________________
+        |         Version(2 Bytes)        |        Type(2 Bytes)        |         Length(Long int/4 Bytes)         |
+        |----------------------------------------------------------------------------------------------------------|
+        |               Source Server IP(4 Bytes)                |         Source Server Port(2 Bytes)             |
+        |__________________________________________________________________________________________________________|
+
+        Every address in a body is 6 bytes too (IP then Port, like the header) instead of 20 characters:
+
+            Register Request:               REQ (3 Chars) + Address (6 Bytes)
+            Advertise Response:             RES (3 Chars) + Address (6 Bytes)
+            Reunion (REQ/RES/AGG/AGB):      Type (3 Chars) + Number of Entries (1 Byte) + Address0 (6 Bytes) + ...
+            Message ID, Blob Transfer ID:   Origin Address (6 Bytes) + Sequence Number (4 Bytes)
+
+        So one reunion packet holds up to 255 entries. The other bodies are the same as version 1.
+        Peers read both versions and send the version they are configured with.
+
+
 """
-# from struct import *
-# from typing import *
+import struct
+import zlib
+from functools import lru_cache
+
+from src.tools.BlobTransfer import chunk_digest, DIGEST_SIZE
+
+# Version, Type, Length, four IP parts (2 bytes each) and Port; see the header table above.
+HEADER_STRUCT = struct.Struct('!HHI4HI')
+HEADER_SIZE = HEADER_STRUCT.size
+
+# Version 2: Version, Type, Length, four IP parts (1 byte each) and Port (2 bytes).
+HEADER_STRUCT_V2 = struct.Struct('!HHI4BH')
+HEADER_SIZE_V2 = HEADER_STRUCT_V2.size
+
+HEADER_STRUCTS = {1: HEADER_STRUCT, 2: HEADER_STRUCT_V2}
+
+# Size of an address in the bodies of every version.
+ADDRESS_SIZES = {1: 15 + 5, 2: 6}
+ADDRESS_STRUCT_V2 = struct.Struct('!4BH')
+
+# Most addresses one reunion packet can hold (the Number of Entries field is 2 chars in version 1, 1 byte in 2).
+MAX_REUNION_ENTRIES = {1: 99, 2: 255}
+
+# Largest packet (header included) a receiver accepts; a connection which announces a larger one is closed.
+MAX_PACKET_SIZE = 16 * 1024 * 1024
+
+# Flags in the first byte of the Type field.
+FLAG_MESSAGE_ID = 0x01
+FLAG_COMPRESSED = 0x02
 
-from src.tools import utils
+# Largest message a compressed Message packet may inflate to.
+MAX_INFLATED_SIZE = 16 * 1024 * 1024
+
+# Origin IP, origin Port and sequence number at the start of a Message body with the Message ID flag.
+MESSAGE_ID_SIZE = 15 + 5 + 10
+MESSAGE_ID_STRUCT_V2 = struct.Struct('!4BHI')
+MESSAGE_ID_SIZES = {1: MESSAGE_ID_SIZE, 2: MESSAGE_ID_STRUCT_V2.size}
+
+# Chunk Index and Chunk Count of a Blob packet, after its Transfer ID.
+BLOB_CHUNK_STRUCT = struct.Struct('!II')
+
+
+@lru_cache(maxsize=1024)
+def _address_fields(ip, port):
+    """
+    Split a server address into the integer fields of the packet header.
+
+    Peers build almost every packet with their own address, so the result is cached.
+
+    :param ip: IP address like '192.168.001.001'.
+    :param port: Port like '05335' or 5335.
+
+    :return: (ip0, ip1, ip2, ip3, port)
+    :rtype: tuple
+    """
+    return tuple(int(part) for part in ip.split('.')) + (int(port),)
+
+
+def _format_address(fields):
+    """
+
+    :param fields: (ip0, ip1, ip2, ip3, port)
+
+    :return: The address in the standard format like ('192.168.001.001', '05335').
+    :rtype: tuple
+    """
+    return '{:03d}.{:03d}.{:03d}.{:03d}'.format(*fields[:4]), '{:05d}'.format(fields[4])
+
+
+def frame_header_size(buf, offset=0):
+    """
+    Header size of the packet which starts at offset of buf; at least the Version field must be there.
+    Unknown versions count as version 1, the packet is rejected when it is parsed.
+
+    :param buf: Received bytes.
+    :param offset: Start of the packet in buf.
+
+    :return: Header size in bytes.
+    :rtype: int
+    """
+    if buf[offset] == 0 and buf[offset + 1] == 2:
+        return HEADER_SIZE_V2
+    return HEADER_SIZE
+
+
+def pack_address(address, version=1):
+    """
+    An address in the body format of the version.
+
+    :param address: Address in the standard format like ('192.168.001.001', '05335').
+    :param version: Packet version.
+
+    :type address: tuple
+    :type version: int
+
+    :return: 20 characters (version 1) or 6 bytes (version 2).
+    :rtype: bytes
+    """
+    if version == 2:
+        return ADDRESS_STRUCT_V2.pack(*_address_fields(address[0], address[1]))
+    return (address[0] + address[1]).encode()
+
+
+def unpack_address(buf, offset=0, version=1):
+    """
+    Read an address which was written with pack_address.
+
+    :param buf: Packet body.
+    :param offset: Start of the address in buf.
+    :param version: Packet version.
+
+    :type buf: bytes or bytearray or memoryview
+    :type offset: int
+    :type version: int
+
+    :return: The address in the standard format like ('192.168.001.001', '05335').
+    :rtype: tuple
+    """
+    if version == 2:
+        return _format_address(ADDRESS_STRUCT_V2.unpack_from(buf, offset))
+    raw = str(buf[offset:offset + 20], 'ascii')
+    return raw[:15], raw[15:]
+
+
+def _pack_message_id(message_id, version):
+    """
+
+    :param message_id: ((origin_ip, origin_port), sequence)
+    :param version: Packet version.
+
+    :return: The ID in the body format of the version.
+    :rtype: bytes
+    """
+    (origin_ip, origin_port), sequence = message_id
+    if version == 2:
+        return MESSAGE_ID_STRUCT_V2.pack(*_address_fields(origin_ip, origin_port), sequence & 0xffffffff)
+    return (origin_ip + origin_port + '{0:010d}'.format(sequence)).encode()
+
+
+def _unpack_message_id(buf, offset, version):
+    """
+
+    :return: ((origin_ip, origin_port), sequence) read from offset of buf.
+    :rtype: tuple
+    """
+    if version == 2:
+        fields = MESSAGE_ID_STRUCT_V2.unpack_from(buf, offset)
+        return _format_address(fields), fields[5]
+    raw = str(buf[offset:offset + MESSAGE_ID_SIZE], 'ascii')
+    return (raw[:15], raw[15:20]), int(raw[20:])
 
 
 class Packet:
@@ -188,25 +415,76 @@ class Packet:
         """
         The decoded buffer should convert to a new packet.
 
+        Only the fixed-size header is parsed here; the IP/Port strings and the body are
+        built lazily on first access, so packets which are only forwarded never pay for them.
+
         :param buf: Input buffer was just decoded.
         :type buf: bytearray
         """
         self.buf = buf
-
-        self.version = int.from_bytes(buf[0:2], byteorder='big', signed=False)
-        self.type = int.from_bytes(buf[2:4], byteorder='big', signed=False)
-        self.length = int.from_bytes(buf[4:8], byteorder='big', signed=False)
-
-        self.ip = utils.bytes_to_ip(buf[8:16])
-
-        self.port = str(int.from_bytes(buf[16:20], byteorder='big', signed=False))
-
-        if utils.DEBUG:
-            print("DDD::version = " + str(self.version), '-type = ' + str(self.type) + '-len = ' + str(self.length) +
-                  '-ip = ' + self.ip + '-port = ' + self.port)
-            print(str(buf[20:]))
-
-        self.body = buf[20:].decode()
+        self._view = memoryview(buf)
+
+        self.version = int.from_bytes(self._view[:2], 'big')
+        if self.version not in HEADER_STRUCTS:
+            raise ValueError('Unknown packet version: ' + str(self.version))
+        header_struct = HEADER_STRUCTS[self.version]
+        self.header_size = header_struct.size
+        fields = header_struct.unpack_from(buf)
+        self.type = fields[1] & 0xff
+        self.flags = fields[1] >> 8
+        self.length = fields[2]
+        self._address_fields = fields[3:]
+
+        self._ip = None
+        self._port = None
+        self._body = None
+        # Decoded parts of the body, kept when a packet is pickled (see decode_body).
+        self._reunion_entries = None
+        self._message = None
+        self._blob_digest_ok = None
+
+    def __getstate__(self):
+        return bytes(self.buf), self._reunion_entries, self._message, self._blob_digest_ok
+
+    def __setstate__(self, state):
+        buf, reunion_entries, message, blob_digest_ok = state
+        self.__init__(buf)
+        self._reunion_entries = reunion_entries
+        self._message = message
+        self._blob_digest_ok = blob_digest_ok
+
+    def decode_body(self):
+        """
+        Decode the parts of the body which cost the most to read (Reunion entries, the text of a compressed Message, the
+        hash check of a Blob chunk) now; they are kept in the packet, also when it's pickled, so e.g. another process
+        can decode a packet before it's handed to the Peer.
+
+        :return:
+        """
+        if self.type == 5:
+            self.get_reunion_entries()
+        elif self.type == 4:
+            self.get_message()
+        elif self.type == 6:
+            self.has_valid_blob_digest()
+
+    @property
+    def ip(self):
+        if self._ip is None:
+            self._ip, self._port = _format_address(self._address_fields)
+        return self._ip
+
+    @property
+    def port(self):
+        if self._port is None:
+            self._ip, self._port = _format_address(self._address_fields)
+        return self._port
+
+    @property
+    def body(self):
+        if self._body is None:
+            self._body = str(self._view[self.header_size:], 'utf-8')
+        return self._body
 
     def get_header(self):
         """
@@ -232,6 +510,14 @@ class Packet:
         """
         return self.type
 
+    def get_flags(self):
+        """
+
+        :return: Packet flags (FLAG_###)
+        :rtype: int
+        """
+        return self.flags
+
     def get_length(self):
         """
 
@@ -248,24 +534,128 @@ class Packet:
         """
         return self.body
 
+    def get_body_bytes(self):
+        """
+        Raw body of the packet without decoding or copying it.
+
+        :return: Packet body
+        :rtype: memoryview
+        """
+        return self._view[self.header_size:]
+
+    def get_body_type(self, size=3):
+        """
+        The characters at the start of the body which tell the kind of the packet ('REQ', 'RES', 'JOIN', ...).
+        Use this instead of get_body for the packets with binary addresses (version 2).
+
+        :param size: Number of characters.
+
+        :return: Body type
+        :rtype: str
+        """
+        return str(self._view[self.header_size:self.header_size + size], 'ascii', 'replace')
+
+    def get_body_address(self, offset=3):
+        """
+        The address in the body of a Register Request or an Advertise Response.
+
+        :param offset: Start of the address in the body.
+
+        :return: The address in the standard format like ('192.168.001.001', '05335').
+        :rtype: tuple
+        """
+        return unpack_address(self._view, self.header_size + offset, self.version)
+
+    def get_reunion_entries(self):
+        """
+        Addresses in the body of a Reunion packet, in the order they are written.
+
+        :return: [(ip0, port0), (ip1, port1), ...]; a new list every time.
+        :rtype: list
+        """
+        if self._reunion_entries is None:
+            start = self.header_size + 3
+            if self.version == 2:
+                entry_num = self._view[start]
+                start += 1
+            else:
+                entry_num = int(str(self._view[start:start + 2], 'ascii'))
+                start += 2
+            size = ADDRESS_SIZES[self.version]
+            self._reunion_entries = [unpack_address(self._view, start + size * i, self.version)
+                                     for i in range(entry_num)]
+        return list(self._reunion_entries)
+
+    def get_message_id(self):
+        """
+        ID of a Message packet with the Message ID flag.
+
+        :return: ((origin_ip, origin_port), sequence), or None if the packet has no ID.
+        :rtype: tuple
+        """
+        if not self.flags & FLAG_MESSAGE_ID:
+            return None
+        return _unpack_message_id(self._view, self.header_size, self.version)
+
+    def get_message(self):
+        """
+        Text of a Message packet, without its ID; a compressed message is inflated here.
+
+        :return: The message
+        :rtype: str
+        """
+        if self._message is not None:
+            return self._message
+        start = self.header_size
+        if self.flags & FLAG_MESSAGE_ID:
+            start += MESSAGE_ID_SIZES[self.version]
+        if not self.flags & FLAG_COMPRESSED:
+            self._message = str(self._view[start:], 'utf-8')
+            return self._message
+        inflater = zlib.decompressobj()
+        message = inflater.decompress(self._view[start:], MAX_INFLATED_SIZE)
+        if inflater.unconsumed_tail:
+            raise ValueError('The compressed message is larger than ' + str(MAX_INFLATED_SIZE) + ' bytes')
+        self._message = str(message, 'utf-8')
+        return self._message
+
+    def get_blob_chunk(self):
+        """
+        The fields of a Blob packet; the data is not copied.
+
+        :return: (transfer_id, index, count, digest, data)
+        :rtype: tuple
+        """
+        transfer_id = _unpack_message_id(self._view, self.header_size, self.version)
+        offset = self.header_size + MESSAGE_ID_SIZES[self.version]
+        index, count = BLOB_CHUNK_STRUCT.unpack_from(self._view, offset)
+        offset += BLOB_CHUNK_STRUCT.size
+        digest = bytes(self._view[offset:offset + DIGEST_SIZE])
+        return transfer_id, index, count, digest, self._view[offset + DIGEST_SIZE:]
+
+    def has_valid_blob_digest(self):
+        """
+
+        :return: Whether the data of a Blob packet has the hash in its header.
+        :rtype: bool
+        """
+        if self._blob_digest_ok is None:
+            transfer_id, index, count, digest, data = self.get_blob_chunk()
+            self._blob_digest_ok = chunk_digest(data) == digest
+        return self._blob_digest_ok
+
     def get_buf(self):
         """
-        In this function, we will make our final buffer that represents the Packet with the Struct class methods.
+        The packet in the network format; packets are never modified after they are made, so this is
+        the buffer they were made from.
 
         :return The parsed packet to the network format.
         :rtype: bytearray
         """
-        b_version = utils.int_to_bytes(self.version, 2)
-        b_type = utils.int_to_bytes(self.type, 2)
-        b_length = utils.int_to_bytes(self.length, 4)
-        b_ip = utils.ip_to_bytes(self.ip)
-        b_port = utils.int_to_bytes(int(self.port), 4)
-        b_body = self.body.encode()
-
-        if utils.DEBUG:
-            if bytearray(b_version + b_type + b_length + b_ip + b_port + b_body) == self.buf:
-                print("DDD::U did it right! :))")
-        return bytearray(b_version + b_type + b_length + b_ip + b_port + b_body)
+        if type(self.buf) is not bytearray:
+            self.buf = bytearray(self.buf)
+            self._view = memoryview(self.buf)
+        return self.buf
 
     def get_source_server_ip(self):
         """
@@ -311,209 +701,222 @@ class PacketFactory:
         return Packet(buffer)
 
     @staticmethod
-    def new_reunion_packet(type: str, source_address: (str, str), nodes_array: list):
+    def new_packet(p_type, source_server_address, body, version=1, flags=0):
+        """
+        Pack the header and the body of a new packet into one buffer.
+
+        :param p_type: Packet type.
+        :param source_server_address: Server address of the packet sender.
+        :param body: Packet body; str bodies are encoded with UTF-8.
+        :param version: Packet version (1 or 2).
+        :param flags: Packet flags (FLAG_###)
+
+        :type p_type: int
+        :type source_server_address: tuple
+        :type body: str or bytes or bytearray or memoryview
+        :type version: int
+        :type flags: int
+
+        :return: New packet.
+        :rtype: Packet
+        """
+        if type(body) is str:
+            body = body.encode()
+        p_ip, p_port = source_server_address
+
+        header_struct = HEADER_STRUCTS[version]
+        buf = bytearray(header_struct.size + len(body))
+        header_struct.pack_into(buf, 0, version, flags << 8 | p_type, len(body), *_address_fields(p_ip, p_port))
+        buf[header_struct.size:] = body
+        return Packet(buf)
+
+    @staticmethod
+    def relay_packet(packet, source_server_address):
         """
-        :param type: Reunion Hello (REQ) or Reunion Hello Back (RES)
+        The same packet with our address as its source, for forwarding it to the next hop.
+        The body is copied as it is, without decoding it.
+
+        :param packet: The arrived packet.
+        :param source_server_address: Server address of the packet sender (us).
+
+        :type packet: Packet
+        :type source_server_address: tuple
+
+        :return: New packet.
+        :rtype: Packet
+        """
+        return PacketFactory.new_packet(packet.type, source_server_address, packet.get_body_bytes(),
+                                        version=packet.version, flags=packet.flags)
+
+    @staticmethod
+    def new_reunion_packet(type: str, source_address: (str, str), nodes_array: list, version=1):
+        """
+        :param type: Reunion Hello (REQ), Reunion Hello Back (RES), Aggregated Hello (AGG) or Aggregated Hello Back (AGB)
         :param source_address: IP/Port address of the packet sender.
         :param nodes_array: [(ip0, port0), (ip1, port1), ...] It is the path to the 'destination'.
+        :param version: Packet version; at most MAX_REUNION_ENTRIES[version] entries fit in one packet.
 
         :type type: str
         :type source_address: tuple
         :type nodes_array: list
+        :type version: int
 
         :return New reunion packet.
         :rtype Packet
         """
-        # Packet Header info
-        p_version = 1
-        p_type = 5  # reunion packet
-        p_length = 5 + 20 * len(nodes_array)
-        p_ip, p_port = source_address
-
-        b_version = utils.int_to_bytes(p_version, 2)
-        b_type = utils.int_to_bytes(p_type, 2)
-        b_length = utils.int_to_bytes(p_length, 4)
-        b_ip = utils.ip_to_bytes(p_ip)
-        b_port = utils.int_to_bytes(int(p_port), 4)
-        header_bytes = b_version + b_type + b_length + b_ip + b_port
-
         number_of_entries = len(nodes_array)
-        p_num_of_entries = '{0:02d}'.format(number_of_entries)
-        # pack body
-        # fmt = '3s' + '2s'
-        # for i in range(number_of_entries):
-        #     fmt += '15s' + '5s'
-        body = type + p_num_of_entries
+        if version == 2:
+            body = [type.encode(), bytes((number_of_entries,))]
+        else:
+            body = [type.encode(), '{0:02d}'.format(number_of_entries).encode()]
 
         # todo: double check this...
-        if type == 'REQ':
-            for i in range(len(nodes_array)):
-                body += nodes_array[i][0] + nodes_array[i][1]
-        elif type == 'RES':
-            for i in range(len(nodes_array) - 1, -1, -1):
-                body += nodes_array[i][0] + nodes_array[i][1]
-
-        body_bytes = body.encode()
+        if type == 'RES':
+            for i in range(number_of_entries - 1, -1, -1):
+                body.append(pack_address(nodes_array[i], version))
+        else:
+            for i in range(number_of_entries):
+                body.append(pack_address(nodes_array[i], version))
 
-        packet_bytes = bytearray(header_bytes + body_bytes)
-        return Packet(packet_bytes)
+        return PacketFactory.new_packet(5, source_address, b''.join(body), version=version)
 
     @staticmethod
-    def new_advertise_packet(type, source_server_address, neighbour=None):
+    def new_advertise_packet(type, source_server_address, neighbour=None, version=1):
         """
         :param type: Type of Advertise packet
         :param source_server_address Server address of the packet sender.
         :param neighbour: The neighbour for advertise response packet; The format is like ('192.168.001.001', '05335').
+        :param version: Packet version.
 
         :type type: str
         :type source_server_address: tuple
         :type neighbour: tuple
+        :type version: int
 
         :return New advertise packet.
         :rtype Packet
 
         """
-        # Packet Header info
-        p_version = 1
-        p_type = 2  # advertise packet
-        p_length = 3
+        body = b''
         if type == 'RES':
-            p_length = 3 + 20
-        elif type == 'REQ':
-            p_length = 3
-
-        p_ip, p_port = source_server_address
-
-        b_version = utils.int_to_bytes(p_version, 2)
-        b_type = utils.int_to_bytes(p_type, 2)
-        b_length = utils.int_to_bytes(p_length, 4)
-        b_ip = utils.ip_to_bytes(p_ip)
-        b_port = utils.int_to_bytes(int(p_port), 4)
-        header_bytes = b_version + b_type + b_length + b_ip + b_port
-
-        # packet body
-        body = ''
-        if type == 'RES':
-            body += type
+            body += type.encode()
             if neighbour is not None:
-                body = body + neighbour[0] + neighbour[1]
+                body += pack_address(neighbour, version)
             else:
                 print("there's a problem... the neighbour address in the advertise response can't be None.")
         elif type == 'REQ':
             body = type
-        body_bytes = body.encode()
 
-        packet_bytes = bytearray(header_bytes + body_bytes)
-        return Packet(packet_bytes)
+        return PacketFactory.new_packet(2, source_server_address, body, version=version)
 
     @staticmethod
-    def new_join_packet(source_server_address):
+    def new_join_packet(source_server_address, version=1):
         """
         :param source_server_address: Server address of the packet sender.
+        :param version: Packet version.
 
         :type source_server_address: tuple
+        :type version: int
 
         :return New join packet.
         :rtype Packet
 
         """
-        # Packet Header info
-        p_version = 1
-        p_type = 3  # advertise packet
-        p_length = 4
-        p_ip, p_port = source_server_address
-
-        b_version = utils.int_to_bytes(p_version, 2)
-        b_type = utils.int_to_bytes(p_type, 2)
-        b_length = utils.int_to_bytes(p_length, 4)
-        b_ip = utils.ip_to_bytes(p_ip)
-        b_port = utils.int_to_bytes(int(p_port), 4)
-        header_bytes = b_version + b_type + b_length + b_ip + b_port
-
-        body = 'JOIN'
-        body_bytes = body.encode()
-
-        packet_bytes = bytearray(header_bytes + body_bytes)
-        return Packet(packet_bytes)
+        return PacketFactory.new_packet(3, source_server_address, 'JOIN', version=version)
 
     @staticmethod
-    def new_register_packet(type, source_server_address, address=(None, None)):
+    def new_register_packet(type, source_server_address, address=(None, None), version=1):
         """
         :param type: Type of Register packet
         :param source_server_address: Server address of the packet sender.
         :param address: If 'type' is 'request' we need an address; The format is like ('192.168.001.001', '05335').
+        :param version: Packet version.
 
         :type type: str
         :type source_server_address: tuple
         :type address: tuple
+        :type version: int
 
         :return New Register packet.
         :rtype Packet
 
         """
-        # Packet Header info
-        p_version = 1
-        p_type = 1  # register packet
-        p_length = 23
-        if type == 'REQ':
-            p_length = 3 + 20
-        elif type == 'RES':
-            p_length = 6
-        p_ip, p_port = source_server_address
-
-        b_version = utils.int_to_bytes(p_version, 2)
-        b_type = utils.int_to_bytes(p_type, 2)
-        b_length = utils.int_to_bytes(p_length, 4)
-        b_ip = utils.ip_to_bytes(p_ip)
-        b_port = utils.int_to_bytes(int(p_port), 4)
-        header_bytes = b_version + b_type + b_length + b_ip + b_port
-
-        # Body
-        body = type
+        body = type.encode()
         if type == 'REQ':
             if address is not None:
-                body = body + address[0] + address[1]
+                body += pack_address(address, version)
             else:
                 print("there's a problem... the address in the register request can't be None.")
         elif type == 'RES':
-            body += 'ACK'
-        body_bytes = body.encode()
+            body += b'ACK'
 
-        packet_bytes = bytearray(header_bytes + body_bytes)
-        return Packet(packet_bytes)
+        return PacketFactory.new_packet(1, source_server_address, body, version=version)
 
     @staticmethod
-    def new_message_packet(message, source_server_address):
+    def new_message_packet(message, source_server_address, message_id=None, version=1, compress_threshold=None):
         """
         Packet for sending a broadcast message to the whole network.
 
+        Relays forward the arrived packet with relay_packet, which keeps its ID and flags and
+        never decodes (or inflates) the body.
+
         :param message: Our message
         :param source_server_address: Server address of the packet sender.
+        :param message_id: ((origin_ip, origin_port), sequence); with it the packet gets the Message ID flag.
+        :param version: Packet version.
+        :param compress_threshold: Compress messages of at least this many bytes (when it makes them smaller);
+                                   None never compresses.
 
-        :type message: str
+        :type message: str or bytes or memoryview
         :type source_server_address: tuple
+        :type message_id: tuple
+        :type version: int
+        :type compress_threshold: int
 
         :return: New Message packet.
         :rtype: Packet
         """
-        p_version = 1
-        p_type = 4  # message packet
-        p_length = len(message)
-        p_ip, p_port = source_server_address
+        flags = 0
+        if compress_threshold is not None:
+            if type(message) is str:
+                message = message.encode()
+            if len(message) >= compress_threshold:
+                compressed = zlib.compress(message)
+                if len(compressed) < len(message):
+                    message = compressed
+                    flags |= FLAG_COMPRESSED
+        if message_id is None:
+            return PacketFactory.new_packet(4, source_server_address, message, version=version, flags=flags)
+        if type(message) is str:
+            message = message.encode()
+        return PacketFactory.new_packet(4, source_server_address, _pack_message_id(message_id, version) + message,
+                                        version=version, flags=flags | FLAG_MESSAGE_ID)
+
+    @staticmethod
+    def new_blob_packet(transfer_id, index, count, data, source_server_address, version=1):
+        """
+        Packet for one chunk of a blob; relays forward it with relay_packet.
 
-        b_version = utils.int_to_bytes(p_version, 2)
-        b_type = utils.int_to_bytes(p_type, 2)
-        b_length = utils.int_to_bytes(p_length, 4)
-        b_ip = utils.ip_to_bytes(p_ip)
-        b_port = utils.int_to_bytes(int(p_port), 4)
-        header_bytes = b_version + b_type + b_length + b_ip + b_port
+        :param transfer_id: ((origin_ip, origin_port), sequence)
+        :param index: Chunk index.
+        :param count: Number of chunks of the blob.
+        :param data: Data of the chunk.
+        :param source_server_address: Server address of the packet sender.
+        :param version: Packet version.
 
-        # Body
-        body = message
-        body_bytes = body.encode()
+        :type transfer_id: tuple
+        :type index: int
+        :type count: int
+        :type data: bytes
+        :type source_server_address: tuple
+        :type version: int
 
-        packet_bytes = bytearray(header_bytes + body_bytes)
-        return Packet(packet_bytes)
+        :return: New Blob packet.
+        :rtype: Packet
+        """
+        body = b''.join((_pack_message_id(transfer_id, version), BLOB_CHUNK_STRUCT.pack(index, count),
+                         chunk_digest(data), data))
+        return PacketFactory.new_packet(6, source_server_address, body, version=version)
 
 
 """
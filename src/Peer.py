@@ -1,13 +1,26 @@
+import asyncio
+import collections
+import hashlib
+import itertools
+import os
+import random
+import sys
+import tempfile
 import threading
 import time
 from typing import *
 
 from src.Stream import Stream
-from src.Packet import Packet, PacketFactory
+from src.AsyncStream import AsyncStream
+from src.Packet import Packet, PacketFactory, MAX_REUNION_ENTRIES
 from src.UserInterface import UserInterface
 from src.tools.Node import Node
 from src.tools import utils
-from src.tools.NetworkGraph import NetworkGraph
+from src.tools.NetworkGraph import NetworkGraph, GraphNode
+from src.tools.DeadlineHeap import DeadlineHeap
+from src.tools.SeenCache import SeenCache
+from src.tools.BlobTransfer import BlobSender, BlobReceiver, CHUNK_SIZE
+from src.tools.OrderedWorkerPool import OrderedWorkerPool
 
 """
     Peer is our main object in this project.
@@ -16,9 +29,16 @@ from src.tools.NetworkGraph import NetworkGraph
     
 """
 
+# Most packets waiting for one packet worker. When they are there the main loop waits before it takes more packets,
+# so the input buffer of the Stream fills up and its server stops reading, like without workers.
+WORKER_BACKLOG = 256
+
 
 class Peer:
-    def __init__(self, server_ip, server_port, is_root=False, root_address=None):
+    def __init__(self, server_ip, server_port, is_root=False, root_address=None, use_asyncio=False,
+                 batch_window=0.0, pipelined=True, nodelay=True, cork=False, reunion_mode='path', packet_version=1,
+                 compress_threshold=None, blob_dir=None, blob_window=16, bulk_budget=64, workers=0, serve=True,
+                 interactive=True):
         """
         The Peer object constructor.
 
@@ -27,6 +47,8 @@ class Peer:
             2. Initialise a PacketFactory object.
             3. Initialise our UserInterface for interaction with user commandline.
             4. Initialise a Thread for handling reunion daemon.
+            5. With use_asyncio, everything runs as coroutines on one event loop instead of threads; make the Peer
+               inside a coroutine on that loop and then await run_async.
 
         Warnings:
             1. For root Peer, we need a NetworkGraph object.
@@ -39,29 +61,131 @@ class Peer:
         :param server_port: Server Port address for this Peer that should be pass to Stream.
         :param is_root: Specify that is this Peer root or not.
         :param root_address: Root IP/Port address if we are a client.
+        :param use_asyncio: Use an AsyncStream and coroutines instead of a Stream and threads.
+        :param batch_window: Seconds to wait after waking up for more packets/commands to handle them together.
+        :param pipelined: Send packets without waiting for an ACK of each one; it must be the same in the whole network.
+        :param nodelay: TCP_NODELAY for our connections to other peers.
+        :param cork: TCP_CORK while flushing our out buffers (Linux only).
+        :param reunion_mode: 'path' sends every Reunion Hello to the root on its own; 'aggregate' merges the hellos of
+                             a sub-tree into one packet per interval on every level. It must be the same in the whole
+                             network.
+        :param packet_version: Version of the packets we make; 2 has binary addresses. We read both versions, so a
+                               network can move to version 2 one peer at a time.
+        :param compress_threshold: Compress our broadcast messages of at least this many bytes; None never compresses.
+                                   Every peer inflates compressed messages, whatever its own setting is.
+        :param blob_dir: Directory for the blobs (files) we receive; a new private temporary directory if it's None.
+        :param blob_window: Chunks of blobs which may wait in the out buffer of a neighbour: we read no more of our
+                            files and relay no more chunks to it until they are sent. Also the early chunks of a blob
+                            we keep while receiving it.
+        :param bulk_budget: Message/Blob packets sent to a neighbour in one iteration of the main loop; control packets
+                            (Register, Advertise, Join, Reunion) always go first, so heartbeats don't wait behind
+                            broadcasts. None sends everything at once.
+        :param workers: Number of threads which handle the arrived packets; the packets of one source are still handled
+                        one by one and in order. With 0 the main loop handles them itself. Not for use_asyncio.
+        :param serve: Listen on our server address. Without it the packets must be fed to stream.feed_in_buf by
+                      someone else, e.g. the acceptors of a RootCluster. Not for use_asyncio.
+        :param interactive: Read the user commands from stdin; without it the Peer is only driven by its methods
+                            (register, advertise, send_message, send_file). In asyncio mode only one Peer of an event
+                            loop can read stdin, since the loop keeps one reader for it.
 
         :type server_ip: str
         :type server_port: int
         :type is_root: bool
         :type root_address: tuple
+        :type use_asyncio: bool
+        :type batch_window: float
+        :type pipelined: bool
+        :type nodelay: bool
+        :type cork: bool
+        :type reunion_mode: str
+        :type packet_version: int
+        :type compress_threshold: int
+        :type blob_dir: str
+        :type blob_window: int
+        :type bulk_budget: int
+        :type workers: int
+        :type serve: bool
+        :type interactive: bool
         """
+        if workers and use_asyncio:
+            raise ValueError('Packet workers need the threaded Stream')
+        if not serve and use_asyncio:
+            raise ValueError('A Peer without its own server needs the threaded Stream')
         self.userInterface = UserInterface()
-        self.address = (server_ip, server_port)
+        self.batch_window = batch_window
+        # The main loop also runs this often when nothing wakes it up.
+        self.idle_timeout = 2
+        self.address = (Node.parse_ip(server_ip), Node.parse_port(server_port))
         self.is_root = is_root
+        if root_address is not None:
+            root_address = (Node.parse_ip(root_address[0]), Node.parse_port(root_address[1]))
         self.root_address = root_address
-        self.stream = Stream(server_ip, server_port)
+        self.use_asyncio = use_asyncio
+        if use_asyncio:
+            self.stream = AsyncStream(server_ip, server_port, pipelined=pipelined, nodelay=nodelay, cork=cork,
+                                      bulk_budget=bulk_budget)
+        else:
+            self.stream = Stream(server_ip, server_port, pipelined=pipelined, nodelay=nodelay, cork=cork,
+                                 bulk_budget=bulk_budget, serve=serve)
+        self.userInterface.on_command = self.stream.notify
+        self.interactive = interactive
+        if interactive and not use_asyncio:
+            self.start_user_interface()
         self.packetfactory = PacketFactory()
-        self.start_user_interface()
+        self.packet_version = packet_version
+        self.compress_threshold = compress_threshold
+        # Called with (message_id, message) for every broadcast message that reaches us; None prints them.
+        self.on_message = None
+        # Made when the first blob arrives, if it's None.
+        self.blob_dir = blob_dir
+        self.blob_window = blob_window
+        # Blobs we are sending, and the blobs we are receiving by their transfer ID.
+        self.blob_senders: List[BlobSender] = []
+        self.blob_receivers: Dict[tuple, BlobReceiver] = {}
+        # Seconds without a new chunk after which a blob we are receiving is given up.
+        self.blob_timeout = 60
+        # When every receiver is given up (on the time.monotonic clock).
+        self.blob_deadlines = DeadlineHeap()
+        # Transfer IDs of our own blobs and the blobs we have finished (received or given up), so a late chunk never
+        # starts (and truncates) a blob again. They are kept much longer than a transfer may stall (blob_timeout).
+        self.finished_blobs = SeenCache(capacity=4096, ttl=600)
+        # Packets taken from the Stream but not handled yet: a Blob packet waits here (and the packets after it, in
+        # their order) until the neighbours it goes to have room for it. Nothing more is taken from the Stream while
+        # they wait, so its server stops reading and the sender is slowed down by TCP.
+        self.held_packets = collections.deque()
+        # Called with (transfer_id, path) for every blob we have received completely; None prints them.
+        self.on_blob = None
         self.hello_sent_time = 0
         self.time_out_limit = 32
+        self.reunion_interval = 4
+        self.reunion_mode = reunion_mode
+        # Aggregate mode: addresses from our children's hellos to send up in the next interval (as an ordered set),
+        # and the child each address came from (with when its last hello came, on the time.monotonic clock), for sending
+        # the Hello Back down.
+        self.pending_hello_entries: Dict[Tuple[str, str], None] = {}
+        self.hello_routes: Dict[Tuple[str, str], Tuple[Tuple[str, str], float]] = {}
+        # IDs of our broadcast messages are (our address, next number of this counter). It starts at a random 32-bit
+        # number (and wraps around there), so after a restart our new IDs are not taken for the old ones which other
+        # peers still remember.
+        self.message_sequence = (n & 0xffffffff for n in itertools.count(random.getrandbits(32)))
+        # IDs of the broadcast messages we have already handled.
+        self.seen_messages = SeenCache(capacity=4096, ttl=60)
         self.last_hello_times = {}
+        # Root only: when every node times out if no Reunion Hello arrives from it (on the time.monotonic clock).
+        self.reunion_deadlines = DeadlineHeap()
         self.registered_nodes: List[Node] = []
         self.parent_address = (None, None)
         self.children_addresses: List[(str, str)] = []
         self.daemon_thread = threading.Thread(target=self.run_reunion_daemon)
+        self.daemon_task = None
+        # Guards the state above (NetworkGraph, registered_nodes, last_hello_times, neighbours, ...) which the main
+        # loop, the reunion daemon and the packet workers share. Don't connect to other nodes while holding it.
+        self._state_lock = threading.RLock()
+        self.worker_pool = OrderedWorkerPool(workers, name='packet-worker',
+                                             capacity=WORKER_BACKLOG) if workers else None
         if is_root:
-            self.daemon_thread.start()
-            self.networkGraph = NetworkGraph(self)
+            self.networkGraph = NetworkGraph(GraphNode(self.address))
+            self.start_reunion_daemon()
         else:
             self.stream.add_node(root_address, set_register_connection=True)
             self.w8_for_back = False
@@ -72,11 +196,36 @@ class Peer:
         """
         For starting UserInterface thread.
 
+        In asyncio mode the event loop reads the commands itself when stdin is readable, if the platform allows it.
+
         :return:
         """
+        if self.use_asyncio:
+            try:
+                asyncio.get_event_loop().add_reader(sys.stdin.fileno(), self.__read_user_command)
+                return
+            except (NotImplementedError, ValueError, OSError):
+                pass
         threading.Thread(target=self.userInterface.run).start()
         pass
 
+    def __read_user_command(self):
+        if not self.userInterface.read_command():
+            asyncio.get_event_loop().remove_reader(sys.stdin.fileno())
+
+    def start_reunion_daemon(self):
+        """
+        Start the reunion daemon thread (or task in asyncio mode) if it is not running now.
+
+        :return:
+        """
+        if self.use_asyncio:
+            if self.daemon_task is None or self.daemon_task.done():
+                self.daemon_task = asyncio.ensure_future(self.run_reunion_daemon_async())
+        elif not self.daemon_thread.is_alive():
+            self.daemon_thread = threading.Thread(target=self.run_reunion_daemon)
+            self.daemon_thread.start()
+
     def handle_user_interface_buffer(self):
         """
         In every interval, we should parse user command that buffered from our UserInterface.
@@ -84,6 +233,8 @@ class Peer:
             1. Register:  With this command, the client send a Register Request packet to the root of the network.
             2. Advertise: Send an Advertise Request to the root of the network for finding first hope.
             3. SendMessage: The following string will be added to a new Message packet and broadcast through the network.
+            4. SendFile: The file at the following path will be broadcast through the network as a blob.
+            5. Stats: Print the hit rate of our duplicate message cache.
 
         Warnings:
             1. Ignore irregular commands from the user.
@@ -92,28 +243,39 @@ class Peer:
         """
         # todo: @mamdos handle this shit... OK baba!
         commands = self.userInterface.buffer
-        is_sendMessage = False
-        for index in range(len(commands)):
-            if is_sendMessage:
-                is_sendMessage = False
-                new_broadcast_message = self.packetfactory.new_message_packet(commands[index], self.address)
-                self.stream.add_message_to_out_buff(self.parent_address, new_broadcast_message.get_buf())
-                for node in self.children_addresses:
-                    self.stream.add_message_to_out_buff(node, new_broadcast_message.get_buf())
-            if commands[index] == 'Register':
-                std_root_addr = (self.root_address[0], Node.parse_port(self.root_address[1]))
-                new_register_packet = self.packetfactory.new_register_packet('REQ', self.address, std_root_addr)
-                self.stream.add_message_to_out_buff(self.root_address, new_register_packet.get_buf())
-            elif commands[index] == 'Advertise':
-                new_advertise_packet = self.packetfactory.new_advertise_packet('REQ', self.address)
-                self.stream.add_message_to_out_buff(self.root_address, new_advertise_packet.get_buf())
-            elif commands[index] == 'SendMessage': # todo: fix the message body pls!
-                is_sendMessage = True
-            commands.pop(index)
-            index -= 1
+        while commands:
+            command = commands[0]
+            if command == 'SendMessage':  # todo: fix the message body pls!
+                if len(commands) < 2:
+                    break  # the message itself has not been written yet
+                self.send_message(commands[1])
+                del commands[:2]
+                continue
+            if command == 'SendFile':
+                if len(commands) < 2:
+                    break  # the path has not been written yet
+                self.send_file(commands[1])
+                del commands[:2]
+                continue
+            if command == 'Stats':
+                print('Seen messages:', self.get_seen_stats())
+            elif command == 'Register':
+                self.register()
+            elif command == 'Advertise':
+                self.advertise()
+            del commands[0]
 
         pass
 
+    def get_seen_stats(self):
+        """
+
+        :return: Hits (duplicates we dropped), misses, evictions, size and hit rate of our cache of seen message IDs.
+        :rtype: dict
+        """
+        with self._state_lock:
+            return self.seen_messages.stats()
+
     def run(self):
         """
         The main loop of the program.
@@ -122,7 +284,7 @@ class Peer:
             2. Handle all packets were received from our Stream server.
             3. Parse user_interface_buffer to make message packets.
             4. Send packets stored in nodes buffer of our Stream object.
-            5. ** sleep the current thread for 2 seconds **
+            5. ** wait until the Stream or the UserInterface has something new (at most idle_timeout seconds) **
 
         Warnings:
             1. At first check reunion daemon condition; Maybe we have a problem in this time
@@ -132,13 +294,72 @@ class Peer:
         :return:
         """
         while True:
-            for buff in self.stream._server_in_buf:
-                packet = PacketFactory.parse_buffer(buff)
+            self.stream.wait(self.idle_timeout)
+            if self.batch_window:
+                time.sleep(self.batch_window)
+            self.__main_loop_step()
+        pass
+
+    async def run_async(self):
+        """
+        The main loop of the program as a coroutine, for a Peer made with use_asyncio.
+
+        :return:
+        """
+        await self.stream.start()
+        if self.interactive:
+            self.start_user_interface()
+        while True:
+            await self.stream.wait(self.idle_timeout)
+            if self.batch_window:
+                await asyncio.sleep(self.batch_window)
+            self.__main_loop_step()
+
+    def __main_loop_step(self):
+        """
+        One iteration of the main loop: handle the received packets and user commands, then send the out buffers.
+
+        :return:
+        """
+        if not self.held_packets:
+            # A RootCluster feeds in Packets which its acceptors have parsed already.
+            self.held_packets.extend(buff if isinstance(buff, Packet) else PacketFactory.parse_buffer(buff)
+                                     for buff in self.stream.drain_in_buf())
+        while self.held_packets:
+            packet = self.held_packets[0]
+            if packet.get_type() == 6 and not self.__blob_room(self.__blob_relay_nodes(packet)):
+                break
+            self.held_packets.popleft()
+            if self.worker_pool is not None:
+                # Keyed by the source, so the packets of every neighbour keep their order.
+                self.worker_pool.submit(packet.get_source_server_address(), self.__handle_packet_in_worker, packet)
+            else:
                 self.handle_packet(packet)
+        with self._state_lock:
             self.handle_user_interface_buffer()
-            self.stream.send_out_buf_messages()  # todo. what is register
-            time.sleep(2)
-        pass
+            self.__send_blob_chunks()
+            self.__expire_blob_receivers()
+        self.stream.send_out_buf_messages()  # todo. what is register
+        # Don't sleep while there is room for more chunks; otherwise sending, reconnecting or a Node (on_writable) wakes
+        # us up when there is.
+        if self.blob_senders and self.__blob_room(self.__blob_target_nodes()):
+            self.stream.notify()
+        elif self.held_packets and self.__blob_room(self.__blob_relay_nodes(self.held_packets[0])):
+            self.stream.notify()
+
+    def __handle_packet_in_worker(self, packet):
+        """
+        handle_packet on a worker thread; then wake the main loop up to send the responses.
+
+        :param packet: The arrived packet.
+        :type packet: Packet
+
+        :return:
+        """
+        try:
+            self.handle_packet(packet)
+        finally:
+            self.stream.notify()
 
     def run_reunion_daemon(self):
         """
@@ -166,41 +387,234 @@ class Peer:
         :return:
         """
 
-        while True:
+        while self.__reunion_daemon_step():
+            # Let the main loop send what we have just buffered.
+            self.stream.notify()
+            time.sleep(self.reunion_interval)  # Fuck You!
+        self.stream.notify()
+        pass
+
+    async def run_reunion_daemon_async(self):
+        """
+        The reunion daemon as a coroutine, for a Peer made with use_asyncio.
+
+        :return:
+        """
+        while self.__reunion_daemon_step():
+            # Let the main loop send what we have just buffered.
+            self.stream.notify()
+            await asyncio.sleep(self.reunion_interval)
+        self.stream.notify()
+
+    def __reunion_daemon_step(self):
+        """
+        One interval of the reunion daemon.
+
+        :return: Whether the daemon should go on.
+        :rtype: bool
+        """
+        with self._state_lock:
             if self.is_root:
-                # check if the reunion time_out has exceeded
-                for address, starting_time in self.last_hello_times.items():
-                    if time.time() - starting_time > self.time_out_limit / 2:
-                        g_node = self.networkGraph.find_node(address[0], address[1])
-                        # turn_off every child of the removing node
-                        up_most_gnode = g_node
-                        children_list = [g_node]
-                        while children_list:
-                            for obj in children_list:
-                                children_list += obj.children
-                                self.networkGraph.turn_off_node(obj.address)
-                                children_list.remove(obj)
-                        self.networkGraph.remove_node(up_most_gnode.address)
-                    else:
-                        pass
+                # only the nodes whose reunion time_out has exceeded
+                for address in self.reunion_deadlines.pop_expired(time.monotonic()):
+                    del self.last_hello_times[address]
+                    if self.networkGraph.find_node(address[0], address[1]) is not None:
+                        # turn_off every node in the sub-tree of the removing node
+                        self.networkGraph.turn_off_subtree(address)
+                        self.networkGraph.remove_node(address)
 
                 pass
             else:  # normal node ... not root
                 if self.w8_for_back:
-                    if time.time() - self.hello_sent_time > self.time_out_limit:
+                    if time.time() - self.hello_sent_time > self.time_out_limit + self.__reunion_slack():
                         self.w8_for_back = False
-                        advertise_pac = self.packetfactory.new_advertise_packet('REQ', self.address)
+                        advertise_pac = self.packetfactory.new_advertise_packet('REQ', self.address,
+                                                                                version=self.packet_version)
                         self.stream.add_message_to_out_buff(self.root_address, advertise_pac.get_buf())
-                        break
+                        return False
                     else:
                         pass
                 else:  # send reunion hello again
                     self.w8_for_back = True
-                    reunion_hello_packet = self.packetfactory.new_reunion_packet('REQ', self.address, [self.address])
-                    self.stream.add_message_to_out_buff(self.parent_address, reunion_hello_packet.get_buf())
+                    if self.reunion_mode == 'path':
+                        reunion_hello_packet = self.packetfactory.new_reunion_packet('REQ', self.address,
+                                                                                     [self.address],
+                                                                                     version=self.packet_version)
+                        self.stream.add_message_to_out_buff(self.parent_address, reunion_hello_packet.get_buf())
                     self.hello_sent_time = time.time()
-            time.sleep(4)  # Fuck You!
-        pass
+                if self.reunion_mode == 'aggregate':
+                    # Our own hello and every hello our sub-tree sent in this interval, all together.
+                    entries = [self.address]
+                    entries += self.pending_hello_entries
+                    self.pending_hello_entries.clear()
+                    self.__send_reunion_entries('AGG', self.parent_address, entries)
+                    # Forget the nodes of our sub-tree which have not sent a hello for a time_out (they are gone or
+                    # have moved to another parent).
+                    oldest = time.monotonic() - self.time_out_limit - self.__reunion_slack()
+                    for address in [a for a, (_, last_seen) in self.hello_routes.items() if last_seen < oldest]:
+                        del self.hello_routes[address]
+            return True
+
+    def __reunion_slack(self):
+        """
+        In aggregate mode a hello waits up to one interval on every level of the tree (not deeper than 8) before the
+        root sees it, so the timeouts are longer by that much.
+
+        :return: Extra seconds for the reunion timeouts.
+        :rtype: float
+        """
+        if self.reunion_mode == 'aggregate':
+            return 8 * self.reunion_interval
+        return 0
+
+    def __send_reunion_entries(self, p_type, address, entries):
+        """
+        Send the addresses in as many reunion packets of p_type as needed; one packet holds at most
+        MAX_REUNION_ENTRIES[version] entries.
+
+        :param p_type: 'AGG' or 'AGB'
+        :param address: Destination address.
+        :param entries: [(ip0, port0), (ip1, port1), ...]
+
+        :return:
+        """
+        step = MAX_REUNION_ENTRIES[self.packet_version]
+        for i in range(0, len(entries), step):
+            packet = self.packetfactory.new_reunion_packet(p_type, self.address, entries[i:i + step],
+                                                           version=self.packet_version)
+            self.stream.add_message_to_out_buff(address, packet.get_buf())
+
+    def register(self):
+        """
+        Send a Register Request to the root of the network; it can be called from any thread.
+
+        :return:
+        """
+        std_root_addr = (self.root_address[0], Node.parse_port(self.root_address[1]))
+        new_register_packet = self.packetfactory.new_register_packet('REQ', self.address, std_root_addr,
+                                                                     version=self.packet_version)
+        self.stream.add_message_to_out_buff(self.root_address, new_register_packet.get_buf())
+        self.stream.notify()
+
+    def advertise(self):
+        """
+        Send an Advertise Request to the root of the network for finding our parent; it can be called from any thread.
+
+        :return:
+        """
+        new_advertise_packet = self.packetfactory.new_advertise_packet('REQ', self.address,
+                                                                       version=self.packet_version)
+        self.stream.add_message_to_out_buff(self.root_address, new_advertise_packet.get_buf())
+        self.stream.notify()
+
+    def send_message(self, message):
+        """
+        Broadcast the message through the network; it can be called from any thread.
+
+        :param message: The text of the message.
+        :type message: str
+
+        :return: The message ID.
+        :rtype: tuple
+        """
+        with self._state_lock:
+            message_id = (self.address, next(self.message_sequence))
+            # It may come back to us through a loop; don't forward it then.
+            self.seen_messages.seen(message_id)
+            new_broadcast_message = self.packetfactory.new_message_packet(
+                message, self.address, message_id, version=self.packet_version,
+                compress_threshold=self.compress_threshold)
+            if not self.is_root:
+                self.stream.add_message_to_out_buff(self.parent_address, new_broadcast_message.get_buf())
+            for node in self.children_addresses:
+                self.stream.add_message_to_out_buff(node, new_broadcast_message.get_buf())
+        self.stream.notify()
+        return message_id
+
+    def send_file(self, path):
+        """
+        Start broadcasting the file at path through the network as a blob; its chunks are read and sent in the next
+        iterations of the main loop, while our neighbours have less than blob_window chunks waiting.
+
+        :param path: The file to send.
+        :type path: str
+
+        :return: The transfer ID, or None if the file can't be read.
+        :rtype: tuple
+        """
+        with self._state_lock:
+            # message_sequence is a generator, which two threads must not run at once.
+            transfer_id = (self.address, next(self.message_sequence))
+        try:
+            sender = BlobSender(transfer_id, path, window=self.blob_window)
+        except OSError as e:
+            print('Can not send the file', path, ':', e)
+            return None
+        with self._state_lock:
+            self.finished_blobs.seen(transfer_id)
+            self.blob_senders.append(sender)
+        return transfer_id
+
+    def __send_blob_chunks(self):
+        """
+        Put the next chunks of the blobs we are sending into the out buffers of our parent and children, as many as
+        fit in the window of the fullest of them.
+
+        :return:
+        """
+        nodes = self.__blob_target_nodes()
+        for sender in self.blob_senders:
+            room = self.__blob_room(nodes)
+            if not room:
+                break
+            # Ours can't expire while it's sent.
+            self.finished_blobs.seen(sender.transfer_id)
+            for index, data in sender.next_chunks(room):
+                packet = self.packetfactory.new_blob_packet(sender.transfer_id, index, sender.count, data, self.address,
+                                                            version=self.packet_version)
+                if not self.is_root:
+                    self.stream.add_message_to_out_buff(self.parent_address, packet.get_buf())
+                for node in self.children_addresses:
+                    self.stream.add_message_to_out_buff(node, packet.get_buf())
+        self.blob_senders = [sender for sender in self.blob_senders if not sender.done()]
+
+    def __blob_target_nodes(self):
+        """
+
+        :return: The nodes of our parent and children, which get the chunks of our blobs.
+        :rtype: list
+        """
+        addresses = list(self.children_addresses)
+        if not self.is_root and self.parent_address != (None, None):
+            addresses.append(self.parent_address)
+        nodes = [self.stream.get_node_by_server(address[0], address[1]) for address in addresses]
+        return [node for node in nodes if node is not None]
+
+    def __blob_relay_nodes(self, packet):
+        """
+
+        :param packet: An arrived Blob packet.
+        :type packet: Packet
+
+        :return: The nodes which __handle_blob_packet relays the packet to.
+        :rtype: list
+        """
+        source_address = packet.get_source_server_address()
+        return [node for node in list(self.stream.nodes)
+                if node.get_server_address() != source_address and not node.is_registered]
+
+    def __blob_room(self, nodes):
+        """
+
+        :param nodes: The nodes which get the next chunks.
+        :type nodes: list
+
+        :return: Number of chunks which fit in the blob_window of every node, next to the bulk packets it has queued.
+        :rtype: int
+        """
+        window = self.blob_window * CHUNK_SIZE
+        queued = max((node.bulk_bytes for node in nodes), default=0)
+        return max(0, window - queued) // CHUNK_SIZE
 
     def send_broadcast_packet(self, broadcast_packet):
         """
@@ -216,7 +630,7 @@ class Peer:
         :return:
         """
         parsed_packet = broadcast_packet.get_buf()
-        for node in self.stream.nodes:
+        for node in list(self.stream.nodes):
             if node.get_server_address() != self.root_address:
                 self.stream.add_message_to_out_buff(node.get_server_address(), parsed_packet)
         pass
@@ -232,7 +646,7 @@ class Peer:
 
         :type packet Packet
         """
-        if packet.length != len(packet.get_body()):
+        if packet.length != len(packet.get_body_bytes()):
             print('The length is not valid')
             raise Exception('The Length not valid Exception')
             # just... do the damn validation tests
@@ -246,8 +660,12 @@ class Peer:
             self.__handle_join_packet(packet)
         elif packet.get_type() == 4:
             self.__handle_message_packet(packet)
-        elif packet.get_type == 5:
-            self.__handle_reunion_packet(packet)
+        elif packet.get_type() == 5:
+            with self._state_lock:
+                self.__handle_reunion_packet(packet)
+        elif packet.get_type() == 6:
+            with self._state_lock:
+                self.__handle_blob_packet(packet)
         else:
             print('Packet type not valid')
         pass
@@ -296,14 +714,25 @@ class Peer:
 
         :return:
         """
-        type = packet.get_body()[:3]
+        type = packet.get_body_type()
         if type == 'REQ':
             if self.is_root:
-                if self.__check_registered(packet.get_source_server_address()):
-                    father_address = self.networkGraph.find_live_node(packet.get_source_server_address()).address
-                    self.networkGraph.add_node(packet.get_source_server_ip(), int(packet.get_source_server_port())
-                                               , father_address)
-                    resp_packet = PacketFactory.new_advertise_packet('RES', self.address, father_address)
+                father = None
+                with self._state_lock:
+                    registered = self.__check_registered(packet.get_source_server_address())
+                    if registered:
+                        father = self.networkGraph.find_live_node(packet.get_source_server_address())
+                    if father is not None:
+                        father_address = father.address
+                        self.networkGraph.add_node(packet.get_source_server_ip(),
+                                                   int(packet.get_source_server_port()), father_address)
+                if registered and father is None:
+                    # Every live node is full (or in the sender's sub-tree); the sender stays out of the network.
+                    if utils.DEBUG:
+                        print("No free neighbour for:", packet.get_source_server_address())
+                elif registered:
+                    resp_packet = PacketFactory.new_advertise_packet('RES', self.address, father_address,
+                                                                       version=self.packet_version)
                     self.stream.add_message_to_out_buff(packet.get_source_server_address(), resp_packet.get_buf())
 
                 else:
@@ -311,14 +740,13 @@ class Peer:
             if not self.is_root:
                 if utils.DEBUG: print("Advertise packet in the wrong address:", self.address)
         if type == 'RES':
-            p_body = packet.get_body()[3:]
-            add = p_body[3:18]
-            port = p_body[18:]
-            self.parent_address = (add, port)
-            self.stream.add_node(self.parent_address, False)
-            join_packet = self.packetfactory.new_join_packet(self.address)
-            self.stream.add_message_to_out_buff(self.parent_address, join_packet.get_buf())
-            self.daemon_thread.start()
+            parent_address = packet.get_body_address()
+            self.stream.add_node(parent_address, False)
+            with self._state_lock:
+                self.parent_address = parent_address
+                self.start_reunion_daemon()
+            join_packet = self.packetfactory.new_join_packet(self.address, version=self.packet_version)
+            self.stream.add_message_to_out_buff(parent_address, join_packet.get_buf())
         pass
 
     def __handle_register_packet(self, packet):
@@ -336,10 +764,12 @@ class Peer:
         :type packet Packet
         :return:
         """
-        p_type = packet.get_body()[:3]
+        p_type = packet.get_body_type()
         if self.is_root:
             if p_type == 'REQ':
-                self.registered_nodes.append(self.stream.add_node(packet.get_source_server_address(), True))
+                node = self.stream.add_node(packet.get_source_server_address(), True)
+                with self._state_lock:
+                    self.registered_nodes.append(node)
             elif p_type == 'RES':
                 pass
         else:
@@ -347,7 +777,8 @@ class Peer:
                 pass
             elif p_type == 'RES':
                 if packet.get_body()[3:] == 'ACK':
-                    advertise_packet = self.packetfactory.new_advertise_packet('REQ', self.address)
+                    advertise_packet = self.packetfactory.new_advertise_packet('REQ', self.address,
+                                                                               version=self.packet_version)
                     self.stream.add_message_to_out_buff(self.address, advertise_packet.get_buf())
                 else:
                     raise Exception('The Register response is not valid')
@@ -378,6 +809,8 @@ class Peer:
         Warnings:
             1. Do not forget to ignore messages from unknown sources.
             2. Make sure that you are not sending a message to a register_connection.
+            3. Drop the messages we have already seen (by their Message ID) before doing anything else with them.
+            4. Forward the body as it arrived; it's only decoded (and inflated) when we deliver the message to on_message.
 
         :param packet: Arrived message packet
 
@@ -385,15 +818,119 @@ class Peer:
 
         :return:
         """
+        message_id = packet.get_message_id()
         source_address = packet.get_source_server_address()
-        new_message_packet = self.packetfactory.new_message_packet(packet.get_body(), self.address)
-        if self.__check_neighbour(source_address):
-            for node in self.stream.nodes:
+        with self._state_lock:
+            if message_id is not None and self.seen_messages.seen(message_id):
+                return
+            from_neighbour = self.__check_neighbour(source_address)
+        new_message_packet = self.packetfactory.relay_packet(packet, self.address)
+        if from_neighbour:
+            for node in list(self.stream.nodes):
                 if node.get_server_address() != source_address and not node.is_registered:
                     self.stream.add_message_to_out_buff(node.get_server_address(), new_message_packet.get_buf())
+            self.__deliver_message(packet)
         else:
             raise Exception('The source was unknown for me!')
 
+    def __handle_blob_packet(self, packet):
+        """
+        Forward a chunk of a blob to the other nodes as soon as it arrives (like a message), and write it to our copy of
+        the blob.
+
+        Warnings:
+            1. Check the chunk hash before doing anything else with the chunk; never forward a broken chunk.
+            2. Drop the chunks we already have, and the ones too far ahead of our copy (out of blob_window).
+
+        :param packet: Arrived blob packet
+
+        :type packet Packet
+
+        :return:
+        """
+        source_address = packet.get_source_server_address()
+        if not self.__check_neighbour(source_address):
+            raise Exception('The source was unknown for me!')
+        transfer_id, index, count, digest, data = packet.get_blob_chunk()
+        if not packet.has_valid_blob_digest():
+            print('Dropped chunk', index, 'of blob', transfer_id, ': wrong hash')
+            return
+        receiver = self.blob_receivers.get(transfer_id)
+        if receiver is None:
+            if transfer_id in self.finished_blobs:
+                return  # ours, or finished already
+            try:
+                sink = open(self.__blob_path(transfer_id), 'xb')
+            except OSError as e:
+                print('Dropped blob', transfer_id, ':', e)
+                self.finished_blobs.seen(transfer_id)
+                return
+            receiver = BlobReceiver(transfer_id, count, sink, window=self.blob_window)
+            self.blob_receivers[transfer_id] = receiver
+            self.blob_deadlines.schedule(transfer_id, time.monotonic() + self.blob_timeout)
+        if not receiver.accepts(index):
+            return
+        self.blob_deadlines.schedule(transfer_id, time.monotonic() + self.blob_timeout)
+        relay = self.packetfactory.relay_packet(packet, self.address)
+        for node in list(self.stream.nodes):
+            if node.get_server_address() != source_address and not node.is_registered:
+                self.stream.add_message_to_out_buff(node.get_server_address(), relay.get_buf())
+        if receiver.add_chunk(index, data):
+            del self.blob_receivers[transfer_id]
+            self.blob_deadlines.cancel(transfer_id)
+            self.finished_blobs.seen(transfer_id)
+            if self.on_blob is not None:
+                self.on_blob(transfer_id, receiver.sink.name)
+            else:
+                print('Blob from', transfer_id[0], ':', receiver.sink.name)
+
+    def __blob_path(self, transfer_id):
+        """
+        Where a blob we receive is written. The origin address in the transfer ID comes from the network as it is, so
+        the name is only a hash of the ID.
+
+        :param transfer_id: ((origin_ip, origin_port), sequence)
+        :type transfer_id: tuple
+
+        :return: Path of the file.
+        :rtype: str
+        """
+        if self.blob_dir is None:
+            self.blob_dir = tempfile.mkdtemp(prefix='blobs-')
+        name = hashlib.blake2b(repr(transfer_id).encode(), digest_size=16).hexdigest()
+        return os.path.join(self.blob_dir, name + '.blob')
+
+    def __expire_blob_receivers(self):
+        """
+        Give up the blobs which have not got a new chunk for blob_timeout seconds: close and delete what we have of them.
+
+        :return:
+        """
+        for transfer_id in self.blob_deadlines.pop_expired(time.monotonic()):
+            receiver = self.blob_receivers.pop(transfer_id)
+            receiver.close()
+            self.finished_blobs.seen(transfer_id)
+            try:
+                os.remove(receiver.sink.name)
+            except OSError:
+                pass
+            print('Gave up blob', transfer_id, ':', receiver.next_index, 'of', receiver.count, 'chunks')
+
+    def __deliver_message(self, packet):
+        """
+        Give the message of an arrived Message packet to the application (on_message).
+
+        :param packet: Arrived message packet
+        :type packet: Packet
+
+        :return:
+        """
+        message = packet.get_message()
+        if self.on_message is not None:
+            self.on_message(packet.get_message_id(), message)
+        else:
+            print('Message from', packet.get_source_server_address(), ':', message)
+
     def __handle_reunion_packet(self, packet):
         """
         In this function we should handle Reunion packet that had just arrived.
@@ -408,6 +945,15 @@ class Peer:
             Check that you are the end node or not; If not only remove your IP/Port address and send the packet to the next
             address, otherwise you received your response from the root and everything is fine.
 
+        Aggregated Hello (AGG):
+            If you are root Peer, do the Reunion Hello work for every address in the packet and answer the sender (our
+            child) with one Aggregated Hello Back of the same addresses. Otherwise keep the addresses for our own next
+            AGG packet, and remember which child they came from.
+
+        Aggregated Hello Back (AGB):
+            If our address is in the packet our Reunion is accepted; send every child an AGB packet with the other
+            addresses that came from that child.
+
         Warnings:
             1. Every time adding or removing an address from packet don't forget to update Entity Number field.
             2. If you are the root, update last Reunion Hello arrival packet from the sender node and turn it on.
@@ -417,29 +963,29 @@ class Peer:
         :param packet: Arrived reunion packet
         :return:
         """
-        p_type = packet.get_body()[:3]
-        entry_num = int(packet.get_body()[3:5])
-        nodes_array = []
-        for i in range(entry_num):
-            array_entry = (packet.get_body()[5+20*i:5+20*i+15], packet.get_body()[5+20*i+15:5+20*i+15+5])
-            nodes_array.append(array_entry)
-        if self.is_root:
+        p_type = packet.get_body_type()
+        nodes_array = packet.get_reunion_entries()
+        entry_num = len(nodes_array)
+        if p_type == 'AGG' or p_type == 'AGB':
+            self.__handle_aggregated_reunion(p_type, packet.get_source_server_address(), nodes_array)
+        elif self.is_root:
             # update the time of the node/peer(fuck!) that the packet has received from
             if p_type == 'REQ':
-                self.last_hello_times[nodes_array[0]] = time.time()
+                self.__accept_reunion_hello(nodes_array[0])
                 send_to_node_address = nodes_array[-1]
-                self.networkGraph.turn_on_node(send_to_node_address)
-                nodes_array.reverse()
-                new_reunion_back_packet = self.packetfactory.new_reunion_packet('RES', self.address, nodes_array)
+                # new_reunion_packet puts the path in the reverse order itself
+                new_reunion_back_packet = self.packetfactory.new_reunion_packet('RES', self.address, nodes_array,
+                                                                                version=self.packet_version)
                 self.stream.add_message_to_out_buff(send_to_node_address,new_reunion_back_packet.get_buf())
-            elif p_type == 'RES:':
+            elif p_type == 'RES':
                 pass
             else:
                 raise Exception('Reunion packet type is invalid (Root)')
         else:
             if p_type == 'REQ':
                 nodes_array.append(self.address)
-                new_reunion_back_packet = self.packetfactory.new_reunion_packet('REQ', self.address, nodes_array)
+                new_reunion_back_packet = self.packetfactory.new_reunion_packet('REQ', self.address, nodes_array,
+                                                                                version=self.packet_version)
                 send_to_node_address = self.parent_address
                 self.stream.add_message_to_out_buff(send_to_node_address, new_reunion_back_packet.get_buf())
 
@@ -455,9 +1001,13 @@ class Peer:
                         nodes_array.remove(self.address)
                         send_to_node_address = nodes_array[0]
                         if self.__check_neighbour(send_to_node_address):
+                            # new_reunion_packet puts the path in the reverse order itself
+                            nodes_array.reverse()
                             new_reunion_back_packet = self.packetfactory.new_reunion_packet('RES', self.address
-                                                                                            , nodes_array)
-                            self.stream.add_message_to_out_buff(nodes_array[0], new_reunion_back_packet.get_buf())
+                                                                                            , nodes_array,
+                                                                                            version=self.packet_version)
+                            self.stream.add_message_to_out_buff(send_to_node_address,
+                                                                new_reunion_back_packet.get_buf())
                         else:
                             raise Exception('The next address is not a neighbour or something has gone wrong!')
                     else:
@@ -465,6 +1015,57 @@ class Peer:
             else:
                 Exception('Reunion type is invalid (non-root)')
 
+    def __accept_reunion_hello(self, address):
+        """
+        Root only: the node at address is alive; move its reunion deadline and turn it on.
+
+        :param address: Address of the node that sent the Reunion Hello.
+        :type address: tuple
+
+        :return:
+        """
+        now = time.monotonic()
+        self.last_hello_times[address] = now
+        self.reunion_deadlines.schedule(address, now + self.time_out_limit / 2 + self.__reunion_slack())
+        if self.networkGraph.find_node(address[0], address[1]) is not None:
+            self.networkGraph.turn_on_node(address)
+
+    def __handle_aggregated_reunion(self, p_type, source_address, nodes_array):
+        """
+        Handle an Aggregated Hello (AGG) or Aggregated Hello Back (AGB) packet.
+
+        :param p_type: 'AGG' or 'AGB'
+        :param source_address: The neighbour that sent the packet.
+        :param nodes_array: Addresses in the packet.
+
+        :return:
+        """
+        if p_type == 'AGG':
+            if not self.__check_neighbour(source_address):
+                raise Exception('Aggregated Reunion Hello from a node which is not our child!')
+            if self.is_root:
+                for address in nodes_array:
+                    self.__accept_reunion_hello(address)
+                self.__send_reunion_entries('AGB', source_address, nodes_array)
+            else:
+                now = time.monotonic()
+                for address in nodes_array:
+                    self.pending_hello_entries[address] = None
+                    self.hello_routes[address] = (source_address, now)
+        else:
+            if self.is_root or source_address != self.parent_address:
+                raise Exception('Aggregated Reunion Hello Back from a node which is not our parent!')
+            entries_by_child = {}
+            for address in nodes_array:
+                if address == self.address:
+                    self.w8_for_back = False
+                elif address in self.hello_routes:
+                    # The next hello of the node adds its route again.
+                    child_address = self.hello_routes.pop(address)[0]
+                    entries_by_child.setdefault(child_address, []).append(address)
+            for child_address, entries in entries_by_child.items():
+                self.__send_reunion_entries('AGB', child_address, entries)
+
     def __handle_join_packet(self, packet):
         """
         When a Join packet received we should add a new node to our nodes array.
@@ -483,8 +1084,15 @@ class Peer:
         # root, we'll accept the new peer as our child...
 
         packet_source_address = packet.get_source_server_address()
+        with self._state_lock:
+            # The same Join may arrive twice (e.g. sent again after a reconnect); a child which joins again after its
+            # node was removed only needs a new node.
+            known = packet_source_address in self.children_addresses
+            if known and self.stream.get_node_by_server(*packet_source_address) is not None:
+                return
+            if not known:
+                self.children_addresses.append(packet_source_address)
         self.stream.add_node(packet_source_address, False)
-        self.children_addresses.append(packet_source_address)
 
     def __get_neighbour(self, sender):
         """
@@ -495,7 +1103,9 @@ class Peer:
             1. Use your NetworkGraph find_live_node to find the best neighbour.
 
         :param sender: Sender of the packet
-        :return: The specified neighbour for the sender; The format is like ('192.168.001.001', '05335').
+        :return: The specified neighbour for the sender; The format is like ('192.168.001.001', '05335'). None if no
+                 live node has a free slot.
         """
-        return self.networkGraph.find_live_node(sender).address
+        neighbour = self.networkGraph.find_live_node(sender)
+        return neighbour.address if neighbour is not None else None
         pass
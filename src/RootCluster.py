@@ -0,0 +1,182 @@
+import multiprocessing
+import multiprocessing.connection
+import os
+import struct
+import threading
+import time
+import zlib
+
+from src.Peer import Peer
+from src.Packet import PacketFactory, FLAG_COMPRESSED
+from src.Stream import Stream
+from src.tools.Node import Node
+from src.tools import utils
+from src.tools.simpletcp.serversocket import ServerSocket
+from src.tools.simpletcp.tcpserver import TCPServer
+
+"""
+    A root which uses more than one CPU core.
+    Acceptor processes listen on the root address together (SO_REUSEPORT), so the kernel spreads the connections of the
+    network over them. They receive, frame, parse and validate the packets, decode the costly parts of their bodies
+    (Packet.decode_body) and forward the valid ones over a pipe to the owner, parsed where that saves it work (see
+    PARSED_PACKET_TYPES): one root Peer without a server of its own, which holds the NetworkGraph and all of the other
+    root state.
+
+    The owner still handles every packet, Messages and Blobs too: relaying them needs the children and the out buffers
+    and connections to them, and dropping duplicates needs the seen-cache, which are all root state. At the root that
+    is little work next to the decoding, which the acceptors do now; benchmarks.load --cluster measures the CPU time
+    of the owner and of the acceptors.
+
+"""
+
+# Types of the packets a root can handle: Register, Advertise, Join, Message, Reunion and Blob.
+PACKET_TYPES = frozenset(range(1, 7))
+
+# Types of the packets whose body starts with 'REQ' or 'RES': Register, Advertise and Reunion.
+REQUEST_PACKET_TYPES = frozenset((1, 2, 5))
+
+# Types of the packets which are forwarded parsed: Reunion and Blob. Unpickling a Packet costs the owner more than
+# parsing a small one again, so the others go as frames, unless they are compressed Messages.
+PARSED_PACKET_TYPES = frozenset((5, 6))
+
+
+def validate_packet(frame):
+    """
+    Check that a received frame is a packet the owner can handle, without touching any state, and decode its body.
+
+    :param frame: One complete frame from the FrameDecoder.
+    :type frame: bytes
+
+    :return: The packet to forward to the owner, or None if it should be dropped.
+    :rtype: Packet
+    """
+    try:
+        packet = PacketFactory.parse_buffer(frame)
+        if packet.get_type() not in PACKET_TYPES:
+            return None
+        if packet.get_type() in REQUEST_PACKET_TYPES and packet.get_body_type() not in ('REQ', 'RES'):
+            return None
+        packet.decode_body()
+        if packet.get_type() == 6 and not packet.has_valid_blob_digest():
+            return None
+    except (ValueError, IndexError, struct.error, zlib.error):
+        return None
+    return packet
+
+
+def run_acceptor(ip, port, pipelined, connection):
+    """
+    The main function of an acceptor process; it never returns.
+
+    :param ip: Root IP in the standard format.
+    :param port: Root port in the standard format.
+    :param pipelined: Whether the network is pipelined; otherwise every packet is ACKed like Stream does.
+    :param connection: Write end of the pipe to the owner.
+
+    :type ip: str
+    :type port: str
+    :type pipelined: bool
+    :type connection: multiprocessing.connection.Connection
+
+    :return:
+    """
+
+    def callback(address, queue, data):
+        if not pipelined:
+            queue.put(bytes('ACK', 'utf8'))
+        packet = validate_packet(data)
+        if packet is not None:
+            if packet.get_type() not in PARSED_PACKET_TYPES and not packet.get_flags() & FLAG_COMPRESSED:
+                packet = data
+            # Blocks while the owner is behind, so this acceptor stops reading and TCP slows the senders down.
+            connection.send(packet)
+        elif utils.DEBUG:
+            print("Dropped a malformed packet from:", address)
+
+    server = TCPServer(ip, port, callback, maximum_connections=256, receive_bytes=2048,
+                       frame_decoder=Stream.new_frame_decoder, reuse_port=True)
+    server.run()
+
+
+class RootCluster:
+    def __init__(self, server_ip, server_port, acceptors=None, **peer_options):
+        """
+        Start the acceptor processes and make the owner Peer.
+
+        Warnings:
+            1. Use it under "if __name__ == '__main__':"; on platforms without fork the acceptors import the main
+               module again.
+            2. Only where SO_REUSEPORT exists (Linux, BSD, macOS).
+
+        :param server_ip: Root IP address.
+        :param server_port: Root port.
+        :param acceptors: Number of acceptor processes; the number of CPU cores if it's None.
+        :param peer_options: Other arguments of the owner Peer (reunion_mode, packet_version, workers, ...).
+
+        :type server_ip: str
+        :type server_port: int
+        :type acceptors: int
+        """
+        if acceptors is None:
+            acceptors = os.cpu_count() or 1
+        if acceptors < 1:
+            raise ValueError('A RootCluster needs at least one acceptor')
+        ip = Node.parse_ip(server_ip)
+        port = Node.parse_port(server_port)
+        pipelined = peer_options.get('pipelined', True)
+        # The acceptors are started before the owner, so they are not forked with the threads of the owner.
+        self.acceptors = []
+        self.closed = False
+        readers = []
+        for i in range(acceptors):
+            reader, writer = multiprocessing.Pipe(duplex=False)
+            process = multiprocessing.Process(target=run_acceptor, args=(ip, port, pipelined, writer),
+                                              name='root-acceptor-' + str(i), daemon=True)
+            process.start()
+            writer.close()
+            self.acceptors.append(process)
+            readers.append(reader)
+        self.peer = Peer(server_ip, server_port, is_root=True, serve=False, **peer_options)
+        threading.Thread(target=self.__forward, args=(readers,), daemon=True).start()
+
+    def __forward(self, readers):
+        """
+        Move the packets (frames or parsed Packets) from the acceptor pipes to the input buffer of the owner.
+
+        :param readers: Read ends of the acceptor pipes.
+        :type readers: list
+
+        :return:
+        """
+        stream = self.peer.stream
+        while readers:
+            for reader in multiprocessing.connection.wait(readers):
+                # Like our own server: don't read while the input buffer is full.
+                while stream.inbound_full():
+                    time.sleep(ServerSocket.PAUSED_POLL_INTERVAL)
+                try:
+                    stream.feed_in_buf(reader.recv())
+                except EOFError:
+                    readers.remove(reader)
+                    if utils.DEBUG and not self.closed:
+                        print("A root acceptor has stopped.")
+
+    def run(self):
+        """
+        The main loop of the owner Peer.
+
+        :return:
+        """
+        self.peer.run()
+
+    def close(self):
+        """
+        Stop the acceptor processes.
+
+        :return:
+        """
+        self.closed = True
+        for process in self.acceptors:
+            process.terminate()
+        for process in self.acceptors:
+            process.join()
@@ -1,22 +1,37 @@
 from src.tools.simpletcp.tcpserver import TCPServer
+from src.tools.simpletcp.framedecoder import FrameDecoder
 from src.tools.Node import Node
+from src.tools.InboundQueue import InboundQueue
+from src.Packet import frame_header_size, MAX_PACKET_SIZE
 import threading
 from typing import *
 
 
 class Stream:
+    # The class used for connections to other peers; see AsyncStream.
+    node_class = Node
 
-    def __init__(self, ip, port):
+    def __init__(self, ip, port, pipelined=True, nodelay=True, cork=False, inbound_capacity=4096, bulk_budget=64,
+                 serve=True):
         """
         The Stream object constructor.
 
         Code design suggestion:
             1. Make a separate Thread for your TCPServer and start immediately.
 
-
+        Warnings:
+            1. All peers of a network must use the same 'pipelined' mode; a non-pipelined node waits for an ACK which a
+               pipelined server never sends.
 
         :param ip: 15 characters
         :param port: 5 characters
+        :param pipelined: Send packets back to back without the ACK round trip after each of them.
+        :param nodelay: TCP_NODELAY for the connections to other nodes.
+        :param cork: TCP_CORK while flushing the out buffers of the nodes.
+        :param inbound_capacity: Received packets waiting to be handled which make our server stop reading; it reads
+                                 again when half of them are handled.
+        :param bulk_budget: Bulk packets (broadcasts) sent to a node in one flush, after all of its control packets.
+        :param serve: Start our TCPServer; without it the packets only come in through feed_in_buf.
         """
 
         def callback(address, queue, data):
@@ -25,22 +40,59 @@ class Stream:
 
             :param address: Source address.
             :param queue: Response queue.
-            :param data: The data received from the socket.
+            :param data: One complete packet received from the socket.
             :return:
             """
-            queue.put(bytes('ACK', 'utf8'))
-            self._server_in_buf.append(data)
+            if not self.pipelined:
+                queue.put(bytes('ACK', 'utf8'))
+            self._in_queue.put(data)
 
         ip = Node.parse_ip(ip)
         port = Node.parse_port(port)
-        self._server_in_buf = []
+        self.pipelined = pipelined
+        self.nodelay = nodelay
+        self.cork = cork
+        self.bulk_budget = bulk_budget
+        self._in_queue = InboundQueue(inbound_capacity)
         self.parent_node_address = (None, None)
         self.nodes: List[Node] = []
-        self.server = TCPServer(ip, port, callback, maximum_connections=256, receive_bytes=2048)
-        threading.Thread(target=self.server.run).start()
+        # Guards changes of 'nodes' and of the index below; nodes may be added from several threads (Peer workers).
+        self._nodes_lock = threading.Lock()
+        # Canonical server address -> the first node in 'nodes' with that address.
+        self._nodes_by_address: Dict[Tuple[str, str], Node] = {}
+        # Nodes which wait to reconnect.
+        self._disconnected_nodes: Set[Node] = set()
+        # Called with (node, state) when the connection state of a node changes (see Node.CONNECTED, ...).
+        self.on_node_state = None
+        self.server = None
+        if serve:
+            self.start_server(ip, port, callback)
         # todo: problem!. update:I think it's solved!
         pass
 
+    def start_server(self, ip, port, callback):
+        """
+        Start our TCPServer in a separate thread.
+
+        :param ip: 15 characters
+        :param port: 5 characters
+        :param callback: The function to call for every packet received by the server.
+
+        :return:
+        """
+        self.server = TCPServer(ip, port, callback, maximum_connections=256, receive_bytes=2048,
+                                frame_decoder=self.new_frame_decoder, read_paused=self.inbound_full)
+        threading.Thread(target=self.server.run).start()
+
+    @staticmethod
+    def new_frame_decoder():
+        """
+
+        :return: A decoder that splits the bytes received on one connection into packets.
+        :rtype: FrameDecoder
+        """
+        return FrameDecoder(frame_header_size, length_offset=4, max_frame_size=MAX_PACKET_SIZE)
+
     def get_server_address(self):
         """
 
@@ -55,7 +107,7 @@ class Stream:
 
         :return:
         """
-        self._server_in_buf.clear()
+        self._in_queue.drain()
 
     def add_node(self, server_address, set_register_connection=False):
         """
@@ -70,11 +122,50 @@ class Stream:
         :return:
         """
         # todo: what is setnode?
-        node = Node(server_address, set_root=set_register_connection, set_register=set_register_connection)
-        self.nodes.append(node)
+        # The node connects on a thread of its own; node_state_changed wakes us up when it's done.
+        node = self.node_class(server_address, set_root=set_register_connection, set_register=set_register_connection,
+                               pipelined=self.pipelined, nodelay=self.nodelay, cork=self.cork,
+                               bulk_budget=self.bulk_budget, on_state_change=self.node_state_changed,
+                               on_writable=self.node_writable)
+        with self._nodes_lock:
+            self.nodes.append(node)
+            self._nodes_by_address.setdefault(node.get_server_address(), node)
         return node
         pass
 
+    def node_state_changed(self, node, state):
+        """
+        Nodes report the changes of their connection state here, maybe from the thread which connects them; 'wait' is
+        woken up, so the messages buffered while connecting are sent or the next reconnect is planned.
+
+        :param node: The node.
+        :param state: Its new state.
+
+        :type node: Node
+        :type state: str
+
+        :return:
+        """
+        with self._nodes_lock:
+            if state == Node.DISCONNECTED:
+                self._disconnected_nodes.add(node)
+            else:
+                self._disconnected_nodes.discard(node)
+        self.notify()
+        if self.on_node_state is not None:
+            self.on_node_state(node, state)
+
+    def node_writable(self, node):
+        """
+        A node has sent the bulk packets it held back; wake up 'wait', so more of them (e.g. blob chunks) are queued.
+
+        :param node: The node.
+        :type node: Node
+
+        :return:
+        """
+        self.notify()
+
     def remove_node(self, node):
         """
         Remove the node from our Stream.
@@ -87,7 +178,18 @@ class Stream:
 
         :return:
         """
-        self.nodes.remove(node)
+        with self._nodes_lock:
+            if node not in self.nodes:
+                return  # removed by another thread already
+            self.nodes.remove(node)
+            address = node.get_server_address()
+            if self._nodes_by_address.get(address) is node:
+                del self._nodes_by_address[address]
+                # Another node may have the same address (e.g. the register connection and the child connection).
+                for other in self.nodes:
+                    if other.get_server_address() == address:
+                        self._nodes_by_address[address] = other
+                        break
         node.close()
         pass
 
@@ -105,13 +207,11 @@ class Stream:
         :return: The node that input address.
         :rtype: Node
         """
-        ip = Node.parse_ip(ip)
-        port = Node.parse_port(port)
-        for node in self.nodes:
-            node_server_address = node.get_server_address()
-            if node_server_address[0] == ip and node_server_address[1] == port:
-                return node
-        return None
+        # Addresses are almost always in the standard format already, so try them as they are first.
+        node = self._nodes_by_address.get((ip, port))
+        if node is None:
+            node = self._nodes_by_address.get((Node.parse_ip(ip), Node.parse_port(port)))
+        return node
         pass
 
     def add_message_to_out_buff(self, address, message):
@@ -136,10 +236,67 @@ class Stream:
         """
         Only returns the input buffer of our TCPServer.
 
-        :return: TCPServer input buffer.
+        :return: A copy of the TCPServer input buffer.
+        :rtype: list
+        """
+        return self._in_queue.snapshot()
+
+    def drain_in_buf(self, max_packets=None):
+        """
+        Take the packets in the input buffer of our TCPServer; each packet is returned only once.
+        The server stops reading while the buffer is full, so drain it often.
+
+        :param max_packets: Maximum number of packets to take; None takes all of them.
+        :type max_packets: int
+
+        :return: Received packets in their arrival order.
         :rtype: list
         """
-        return self._server_in_buf
+        return self._in_queue.drain(max_packets)
+
+    def feed_in_buf(self, data):
+        """
+        Add a packet which was received by someone else than our TCPServer (e.g. a RootCluster acceptor) to the input
+        buffer; it can be called from any thread. Check inbound_full before, like our server does.
+
+        :param data: One complete packet, or a Packet which was parsed already.
+        :type data: bytes or Packet
+
+        :return:
+        """
+        self._in_queue.put(data)
+
+    def inbound_full(self):
+        """
+
+        :return: Whether the input buffer is full and our server should stop reading.
+        :rtype: bool
+        """
+        return self._in_queue.full()
+
+    def notify(self):
+        """
+        Wake up whoever is in 'wait'; it can be called from any thread. Received packets wake it up by themselves.
+
+        :return:
+        """
+        self._in_queue.notify()
+
+    def wait(self, timeout=None):
+        """
+        Block until a packet is received, 'notify' is called or timeout seconds have passed.
+        It returns earlier when a disconnected node should try to reconnect.
+
+        :param timeout: Maximum time to wait in seconds; None waits forever.
+        :type timeout: float
+
+        :return:
+        """
+        for node in list(self._disconnected_nodes):
+            delay = node.reconnect_delay()
+            if delay is not None and (timeout is None or delay < timeout):
+                timeout = delay
+        self._in_queue.wait(timeout)
 
     def send_messages_to_node(self, node: Node):
         """
@@ -148,6 +305,7 @@ class Stream:
         Warnings:
             1. Insert an exception handler here; Maybe the node socket you want to send the message has turned off and
             you need to remove this node from stream nodes.
+            2. A node reconnects by itself after short failures; it only raises when it has given up.
 
         :param node:
         :type node Node
@@ -164,14 +322,20 @@ class Stream:
     def send_out_buf_messages(self, only_register=False):
         """
         In this function, we will send hole out buffers to their own clients.
+        If the bulk budget leaves messages in some buffers, 'wait' returns at once so the next flush comes soon.
 
         :return:
         """
+        # Nodes which fail are removed while we go.
         if only_register:
-            for node in self.nodes:
+            for node in list(self.nodes):
                 if node.is_registered:
                     self.send_messages_to_node(node)
         else:
-            for node in self.nodes:
+            for node in list(self.nodes):
                 self.send_messages_to_node(node)
+        for node in self.nodes:
+            if node.has_pending_messages():
+                self.notify()
+                break
         pass
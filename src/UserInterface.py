@@ -1,3 +1,4 @@
+import sys
 import threading
 import time
 from typing import *
@@ -6,6 +7,20 @@ from typing import *
 class UserInterface:
     buffer: List[str] = []
 
+    def __init__(self, on_command=None):
+        """
+
+        :param on_command: Called with no arguments whenever a new command is buffered; e.g. to wake up the Peer.
+        :type on_command: callable
+        """
+        self.on_command = on_command
+
+    def add_command(self, message):
+        print("I've got ", message)
+        self.buffer.append(message)
+        if self.on_command is not None:
+            self.on_command()
+
     def run(self):
         """
         Which the user or client sees and works with.
@@ -13,5 +28,19 @@ class UserInterface:
         """
         while True:
             message = input("Write your command:\n")
-            print("I've got ", message)
-            self.buffer.append(message)
+            self.add_command(message)
+
+    def read_command(self):
+        """
+        Read one command from stdin without blocking; event loops call it when stdin is readable.
+
+        :return: False when stdin is closed.
+        :rtype: bool
+        """
+        message = sys.stdin.readline()
+        if not message:
+            return False
+        message = message.strip()
+        if message:
+            self.add_command(message)
+        return True
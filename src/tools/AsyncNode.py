@@ -0,0 +1,170 @@
+import asyncio
+import socket
+
+from src.tools.Node import Node
+
+
+class NodeProtocol(asyncio.Protocol):
+    def __init__(self, node):
+        """
+        asyncio protocol for the connection of an AsyncNode.
+
+        :param node: The node this connection belongs to.
+        :type node: AsyncNode
+        """
+        self.node = node
+
+    def connection_made(self, transport):
+        sock = transport.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 if self.node.nodelay else 0)
+        # pause_writing is called once the transport holds more than BULK_HIGH_WATER bytes, resume_writing when it
+        # has written most of them.
+        transport.set_write_buffer_limits(high=self.node.BULK_HIGH_WATER)
+        self.node.writing_paused = False
+        self.node.transport = transport
+
+    def pause_writing(self):
+        self.node.writing_paused = True
+
+    def resume_writing(self):
+        self.node.writing_paused = False
+        # Nobody polls for the bulk packets which were held back, so send them now.
+        while self.node.has_pending_messages():
+            self.node.send_message()
+        if self.node.on_writable is not None:
+            self.node.on_writable(self.node)
+
+    def data_received(self, data):
+        # Responses of the other peer's server (e.g. ACKs) are not used.
+        pass
+
+    def connection_lost(self, exc):
+        self.node.transport = None
+        if not self.node.closed:
+            self.node.connection_failed(exc or ConnectionResetError('Connection closed by ' +
+                                                                    str(self.node.get_server_address())))
+
+
+class AsyncNode(Node):
+    """
+    A Node whose connection is an asyncio transport instead of a blocking ClientSocket.
+
+    It reconnects with the same backoff as a Node, on a timer of the event loop.
+
+    Warnings:
+        1. Make and use it only in the thread that runs the event loop.
+    """
+
+    # Bulk packets are only handed to the transport while it has less than this many bytes to write, so a control
+    # packet never waits behind more than that.
+    BULK_HIGH_WATER = 64 * 1024
+
+    def __init__(self, server_address, set_root=False, set_register=False, pipelined=True, nodelay=True, cork=False,
+                 bulk_budget=64, on_state_change=None, on_writable=None):
+        self.transport = None
+        # Whether the transport holds more than BULK_HIGH_WATER bytes; bulk packets wait until it's written.
+        self.writing_paused = False
+        self.closed = False
+        self._connecting = None
+        self._reconnect_handle = None
+        # Transports never wait for responses, so 'pipelined' only decides whether the server answers with ACKs.
+        # The transport buffers and coalesces writes itself, so 'cork' is not used.
+        super().__init__(server_address, set_root=set_root, set_register=set_register, pipelined=pipelined,
+                         nodelay=nodelay, cork=cork, bulk_budget=bulk_budget, on_state_change=on_state_change,
+                         on_writable=on_writable)
+
+    def connect(self):
+        """
+        Start connecting to the Node TCPServer address; messages stay in out_buff until it is done.
+
+        :return:
+        """
+        self._reconnect_handle = None
+        self._connecting = asyncio.ensure_future(self.__connect())
+
+    async def __connect(self):
+        loop = asyncio.get_event_loop()
+        try:
+            await asyncio.wait_for(loop.create_connection(lambda: NodeProtocol(self), self.server_ip,
+                                                          int(self.server_port)), self.CONNECT_TIMEOUT)
+        except (OSError, asyncio.TimeoutError) as e:
+            print(str(e))
+            self.connection_failed(e)
+            return
+        self.reconnect_attempts = 0
+        self.error = None
+        self.set_state(Node.CONNECTED)
+        # Send what was buffered while we were connecting.
+        if self.has_pending_messages():
+            self.send_message()
+
+    def connection_failed(self, error):
+        """
+        Like Node.connection_failed, and start the timer of the next attempt.
+
+        :param error: What went wrong.
+        :type error: Exception
+
+        :return: Seconds until the next attempt, or None if we gave up.
+        :rtype: float
+        """
+        delay = super().connection_failed(error)
+        if delay is not None and not self.closed:
+            self._reconnect_handle = asyncio.get_event_loop().call_later(delay, self.connect)
+        return delay
+
+    def send_message(self):
+        """
+        Hand the buffered messages to the transport, which writes them without blocking: every control packet, then
+        bulk packets while the transport has room for them (BULK_HIGH_WATER) and bulk_budget allows. The bulk packets
+        it holds back are sent when the transport calls resume_writing.
+
+        :return:
+        """
+        if self.state == Node.FAILED:
+            raise ConnectionError('Gave up connecting to ' + str(self.get_server_address())) from self.error
+        if self.transport is None:
+            # Still connecting, or waiting to reconnect.
+            self.trim_buffers()
+            return
+        if self.out_buff:
+            self.transport.writelines(self.out_buff)
+            self.out_buff.clear()
+        if self.writing_paused:
+            return
+        # Fill it over BULK_HIGH_WATER, so the transport pauses us and tells us when there is room again.
+        room = self.BULK_HIGH_WATER - self.transport.get_write_buffer_size()
+        batch = []
+        while self.bulk_buff and room >= 0 and (self.bulk_budget is None or len(batch) < self.bulk_budget):
+            message = self.bulk_buff.popleft()
+            self.bulk_bytes -= len(message)
+            batch.append(message)
+            room -= len(message)
+        if batch:
+            self.transport.writelines(batch)
+
+    def has_pending_messages(self):
+        """
+
+        :return: Whether some messages were left for the next flush which the transport can take now; the bulk
+                 packets held back while it's full don't count.
+        :rtype: bool
+        """
+        if self.state != Node.CONNECTED or self.transport is None:
+            return False
+        return bool(self.out_buff or (self.bulk_buff and not self.writing_paused))
+
+    def close(self):
+        """
+        Closing client's object.
+        :return:
+        """
+        self.closed = True
+        self.set_state(Node.CLOSED)
+        if self._connecting is not None:
+            self._connecting.cancel()
+        if self._reconnect_handle is not None:
+            self._reconnect_handle.cancel()
+        if self.transport is not None:
+            self.transport.close()
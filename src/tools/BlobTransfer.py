@@ -0,0 +1,160 @@
+import hashlib
+import os
+
+# Bytes of data in every chunk of a blob.
+CHUNK_SIZE = 64 * 1024
+
+# Size of the chunk hash (BLAKE2b) in a Blob packet.
+DIGEST_SIZE = 16
+
+
+def chunk_digest(data):
+    """
+
+    :param data: Data of a chunk.
+    :type data: bytes or memoryview
+
+    :return: The content hash of the chunk.
+    :rtype: bytes
+    """
+    return hashlib.blake2b(data, digest_size=DIGEST_SIZE).digest()
+
+
+class BlobSender:
+    def __init__(self, transfer_id, path, chunk_size=CHUNK_SIZE, window=16):
+        """
+        Reads a file chunk by chunk for sending it as a blob; at most 'window' chunks are read in one call of
+        next_chunks, so a big file is never in memory as a whole.
+
+        :param transfer_id: ((origin_ip, origin_port), sequence); the same on every hop, like a Message ID.
+        :param path: The file to send.
+        :param chunk_size: Bytes of data in every chunk.
+        :param window: Maximum number of chunks to read in one call of next_chunks.
+
+        :type transfer_id: tuple
+        :type path: str
+        :type chunk_size: int
+        :type window: int
+        """
+        self.transfer_id = transfer_id
+        self.chunk_size = chunk_size
+        self.window = window
+        size = os.path.getsize(path)
+        # An empty file is still one (empty) chunk.
+        self.count = max(1, -(-size // chunk_size))
+        self.next_index = 0
+        self._file = open(path, 'rb')
+
+    def next_chunks(self, limit=None):
+        """
+        Read the next chunks of the file.
+
+        :param limit: Maximum number of chunks to read, if it's less than the window.
+        :type limit: int
+
+        :return: [(index, data), ...]; empty when every chunk has been read.
+        :rtype: list
+        """
+        chunks = []
+        window = self.window if limit is None else min(self.window, limit)
+        while self.next_index < self.count and len(chunks) < window:
+            chunks.append((self.next_index, self._file.read(self.chunk_size)))
+            self.next_index += 1
+        if self.done():
+            self.close()
+        return chunks
+
+    def done(self):
+        """
+
+        :return: Whether every chunk has been read.
+        :rtype: bool
+        """
+        return self.next_index >= self.count
+
+    def close(self):
+        self._file.close()
+
+
+class BlobReceiver:
+    def __init__(self, transfer_id, count, sink, window=16):
+        """
+        Puts the chunks of a blob back together in the sink.
+
+        Chunks are written as soon as all of the chunks before them are written; at most 'window' chunks which arrive
+        early are kept in memory, later ones are rejected.
+
+        :param transfer_id: ((origin_ip, origin_port), sequence)
+        :param count: Number of chunks of the blob.
+        :param sink: Where the data goes; anything with write() and close(), e.g. a file.
+        :param window: Maximum number of early chunks to keep.
+
+        :type transfer_id: tuple
+        :type count: int
+        :type window: int
+        """
+        self.transfer_id = transfer_id
+        self.count = count
+        self.sink = sink
+        self.window = window
+        self.next_index = 0
+        # index -> data of the chunks that arrived before the ones in front of them.
+        self._early = {}
+
+    def has_chunk(self, index):
+        """
+
+        :param index: Chunk index.
+
+        :return: Whether the chunk has already been added.
+        :rtype: bool
+        """
+        return index < self.next_index or index in self._early
+
+    def accepts(self, index):
+        """
+
+        :param index: Chunk index.
+
+        :return: Whether add_chunk can take the chunk now (it's new and inside the window).
+        :rtype: bool
+        """
+        return not self.has_chunk(index) and index < min(self.count, self.next_index + self.window)
+
+    def add_chunk(self, index, data):
+        """
+        Add an arrived chunk; check it with 'accepts' first.
+
+        :param index: Chunk index.
+        :param data: Data of the chunk.
+
+        :type index: int
+        :type data: bytes or memoryview
+
+        :return: Whether the whole blob has been written now.
+        :rtype: bool
+        """
+        if index != self.next_index:
+            self._early[index] = bytes(data)
+            return False
+        self.sink.write(data)
+        self.next_index += 1
+        while self.next_index in self._early:
+            self.sink.write(self._early.pop(self.next_index))
+            self.next_index += 1
+        if self.done():
+            self.sink.close()
+            return True
+        return False
+
+    def done(self):
+        """
+
+        :return: Whether every chunk has been written.
+        :rtype: bool
+        """
+        return self.next_index >= self.count
+
+    def close(self):
+        self._early.clear()
+        self.sink.close()
@@ -0,0 +1,80 @@
+import heapq
+import itertools
+from typing import *
+
+
+class DeadlineHeap:
+    def __init__(self):
+        """
+        Min-heap of deadlines for keys (e.g. node addresses).
+
+        Rescheduling a key only pushes a new entry; the old one is dropped when it reaches the top. So scheduling is
+        O(log N) and pop_expired only visits the keys which have really expired (and the stale entries before them).
+        Use the same clock for every deadline, preferably time.monotonic().
+        """
+        self.deadlines: Dict[Hashable, float] = {}
+        self._heap = []
+        self._order = itertools.count()
+
+    def schedule(self, key, deadline):
+        """
+        Set (or move) the deadline of the key.
+
+        :param key: Any hashable key.
+        :param deadline: Time of the deadline.
+
+        :type deadline: float
+
+        :return:
+        """
+        self.deadlines[key] = deadline
+        heapq.heappush(self._heap, (deadline, next(self._order), key))
+        # Heartbeats push much more often than entries expire; don't let stale entries pile up.
+        if len(self._heap) > 64 + 4 * len(self.deadlines):
+            self._heap = [(deadline, next(self._order), key) for key, deadline in self.deadlines.items()]
+            heapq.heapify(self._heap)
+
+    def cancel(self, key):
+        """
+        Forget the deadline of the key, if it has one.
+
+        :param key: Any hashable key.
+
+        :return:
+        """
+        self.deadlines.pop(key, None)
+
+    def pop_expired(self, now):
+        """
+        Remove and return every key whose deadline is not after now.
+
+        :param now: Current time.
+        :type now: float
+
+        :return: Expired keys in the order of their deadlines.
+        :rtype: list
+        """
+        expired = []
+        heap = self._heap
+        while heap and heap[0][0] <= now:
+            deadline, _, key = heapq.heappop(heap)
+            if self.deadlines.get(key) == deadline:
+                del self.deadlines[key]
+                expired.append(key)
+        return expired
+
+    def next_deadline(self):
+        """
+
+        :return: The earliest deadline, or None if there is no deadline.
+        :rtype: float
+        """
+        while self._heap and self.deadlines.get(self._heap[0][2]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+        return self._heap[0][0] if self._heap else None
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def __contains__(self, key):
+        return key in self.deadlines
@@ -0,0 +1,111 @@
+import threading
+from collections import deque
+
+
+class InboundQueue:
+    def __init__(self, capacity=4096, low_water=None):
+        """
+        Thread-safe queue of the received packets, between the server (producer) and the Peer main loop (consumer).
+
+        put never blocks or drops; the producer checks 'full' and stops reading from its sockets until the consumer
+        has drained the queue, so the queue holds at most about capacity packets.
+        Once full, the queue stays full until it is down to low_water packets, so the producer doesn't pause and
+        resume its reading for every packet under a steady load.
+
+        :param capacity: Number of packets which makes the queue full.
+        :param low_water: Number of packets which makes a full queue not full again; half of capacity if it's None.
+
+        :type capacity: int
+        :type low_water: int
+        """
+        self.capacity = capacity
+        self.low_water = capacity // 2 if low_water is None else low_water
+        # Whether the queue is full now; see 'full'.
+        self._full = False
+        self._items = deque()
+        self._condition = threading.Condition(threading.Lock())
+        # Set by 'notify' so a 'wait' returns even with nothing in the queue.
+        self._woken = False
+        # The largest number of packets the queue has held.
+        self.high_water = 0
+
+    def put(self, item):
+        """
+        Add an item and wake up whoever is in 'wait'.
+
+        :param item: A received packet.
+
+        :return:
+        """
+        with self._condition:
+            self._items.append(item)
+            if len(self._items) > self.high_water:
+                self.high_water = len(self._items)
+            self._condition.notify()
+
+    def full(self):
+        """
+
+        :return: Whether the producer should stop reading until the queue is drained.
+        :rtype: bool
+        """
+        size = len(self._items)
+        if self._full:
+            if size <= self.low_water:
+                self._full = False
+        elif size >= self.capacity:
+            self._full = True
+        return self._full
+
+    def drain(self, max_items=None):
+        """
+        Take the oldest items out of the queue; every item is returned only once.
+
+        :param max_items: Maximum number of items to take; None takes all of them.
+        :type max_items: int
+
+        :return: Items in the order they were put.
+        :rtype: list
+        """
+        with self._condition:
+            items = self._items
+            if max_items is None or max_items >= len(items):
+                self._items = deque()
+                return list(items)
+            return [items.popleft() for _ in range(max_items)]
+
+    def snapshot(self):
+        """
+
+        :return: The items in the queue, without taking them.
+        :rtype: list
+        """
+        with self._condition:
+            return list(self._items)
+
+    def notify(self):
+        """
+        Wake up whoever is in 'wait', even if the queue is empty; it can be called from any thread.
+
+        :return:
+        """
+        with self._condition:
+            self._woken = True
+            self._condition.notify()
+
+    def wait(self, timeout=None):
+        """
+        Block until there is an item in the queue, 'notify' is called or timeout seconds have passed.
+
+        :param timeout: Maximum time to wait in seconds; None waits forever.
+        :type timeout: float
+
+        :return:
+        """
+        with self._condition:
+            if not self._items and not self._woken:
+                self._condition.wait(timeout)
+            self._woken = False
+
+    def __len__(self):
+        return len(self._items)
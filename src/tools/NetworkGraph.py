@@ -1,3 +1,5 @@
+import heapq
+import itertools
 import time
 from src.tools.Node import Node
 from typing import *
@@ -15,6 +17,12 @@ class GraphNode:
         self.alive = False
         self.children: List[GraphNode] = []
         self.parent: GraphNode = None
+        self.depth = 0
+        # Ancestors from the root to the parent, so path[d] is the ancestor at depth d; None while the node is
+        # detached from the root (its parent was removed and it has not re-joined yet).
+        self.path: Tuple[GraphNode, ...] = ()
+        # The valid entry for this node in the frontier of its NetworkGraph, if any.
+        self.frontier_entry = None
         pass
 
     def set_parent(self, parent):
@@ -37,10 +45,35 @@ class GraphNode:
 
 
 class NetworkGraph:
+    # Maximum number of children for every node.
+    max_children = 2
+
     def __init__(self, root):
+        """
+
+        :param root: The root of the network.
+        :type root: GraphNode
+        """
         self.root = root
         root.alive = True
-        self.nodes: List[GraphNode] = [root]
+        root.set_address(NetworkGraph.parse_address(root.address))
+        # Address like ('192.168.001.001', '05335') -> GraphNode
+        self.nodes: Dict[Tuple[str, str], GraphNode] = {root.address: root}
+        # Min-heap of (depth, order, node) for the nodes that may have a free child slot. Entries are checked when
+        # they reach the top, so a node which is not a candidate any more (or an entry which is not the node's
+        # frontier_entry any more) is only dropped then.
+        self.frontier = []
+        self.__order = itertools.count()
+        self.__push_frontier(root)
+
+    def __is_candidate(self, node):
+        return (node.alive and len(node.children) < self.max_children and node.path is not None
+                and self.nodes.get(node.address) is node)
+
+    def __push_frontier(self, node):
+        if node.frontier_entry is None and self.__is_candidate(node):
+            node.frontier_entry = (node.depth, next(self.__order), node)
+            heapq.heappush(self.frontier, node.frontier_entry)
 
     def find_live_node(self, sender):
         """
@@ -49,6 +82,7 @@ class NetworkGraph:
 
         Code design suggestion:
             1. Do a BFS algorithm to find the target.
+               (Now the shallowest live node with a free slot is always on top of our frontier heap.)
 
         Warnings:
             1. Check whether there is sender node in our NetworkGraph or not; if exist do not return sender node or
@@ -60,27 +94,98 @@ class NetworkGraph:
         :return: Best neighbour for sender.
         :rtype: GraphNode
         """
-        if self.find_node(sender[0], sender[1]) is not None:
-            return None
-        node_list: list[GraphNode] = [self.root]
-        while node_list:
-            for node in node_list:
-                if len(node.children) < 2:  # is this syntax right?!
-                    return node
-                node_list += node.children
-                node_list.remove(node)
-        pass
+        sender_node = self.find_node(sender[0], sender[1])
+        skipped = []
+        best = None
+        while self.frontier:
+            entry = self.frontier[0]
+            node = entry[2]
+            if node.frontier_entry is not entry:
+                heapq.heappop(self.frontier)
+                continue
+            if not self.__is_candidate(node):
+                node.frontier_entry = None
+                heapq.heappop(self.frontier)
+                continue
+            if sender_node is not None and self.is_in_subtree(node, sender_node):
+                # It's a good candidate for others; put it back when we are done.
+                skipped.append(heapq.heappop(self.frontier))
+                continue
+            best = node
+            break
+        for entry in skipped:
+            heapq.heappush(self.frontier, entry)
+        return best
+
+    def is_in_subtree(self, node, subtree_root):
+        """
+
+        :param node: The node we want to check.
+        :param subtree_root: Root of the sub-tree.
+
+        :type node: GraphNode
+        :type subtree_root: GraphNode
+
+        :return: Whether node is subtree_root or one of its descendants.
+        :rtype: bool
+        """
+        if node is subtree_root:
+            return True
+        if node.path is None or subtree_root.path is None:
+            # Detached nodes have no path; their sub-trees are still linked by parent.
+            while node is not None:
+                if node is subtree_root:
+                    return True
+                node = node.parent
+            return False
+        return node.depth > subtree_root.depth and node.path[subtree_root.depth] is subtree_root
+
+    def get_subtree(self, node_address):
+        """
+
+        :param node_address: Address of the sub-tree root.
+        :type node_address: tuple
+
+        :return: The node and all of its descendants; empty if there is no such node.
+        :rtype: list
+        """
+        node = self.find_node(node_address[0], node_address[1])
+        if node is None:
+            return []
+        subtree = [node]
+        i = 0
+        while i < len(subtree):
+            subtree.extend(subtree[i].children)
+            i += 1
+        return subtree
+
+    def turn_off_subtree(self, node_address):
+        """
+        Turn off the node and every node in its sub-tree.
+
+        :param node_address: Address of the sub-tree root.
+        :type node_address: tuple
+
+        :return: The nodes that were turned off.
+        :rtype: list
+        """
+        subtree = self.get_subtree(node_address)
+        for node in subtree:
+            node.alive = False
+        return subtree
 
     def find_node(self, ip, port):
-        for node in self.nodes:
-            if node.address[0] == ip and node.address[1] == port:
-                return node
-        return None
+        # Addresses are almost always in the standard format already, so try them as they are first.
+        node = self.nodes.get((ip, port))
+        if node is None:
+            node = self.nodes.get(NetworkGraph.parse_address((ip, port)))
+        return node
         pass
 
     def turn_on_node(self, node_address):
         node = self.find_node(node_address[0], node_address[1])
         node.alive = True
+        self.__push_frontier(node)
         pass
 
     def turn_off_node(self, node_address):
@@ -92,14 +197,21 @@ class NetworkGraph:
         node = self.find_node(node_address[0], node_address[1])
         for child in node.children:
             child.set_parent(None)
+        # The rest of the sub-tree is detached from the root until it joins again.
+        for descendant in self.get_subtree(node.address)[1:]:
+            descendant.path = None
+            descendant.frontier_entry = None
         parent_node = node.parent
-        parent_node.children.remove(node)
-        self.nodes.remove(node)
+        del self.nodes[node.address]
+        if parent_node is not None:
+            parent_node.children.remove(node)
+            self.__push_frontier(parent_node)
         pass
 
     def add_node(self, ip, port, father_address):
         """
         Add a new node with node_address if it does not exist in our NetworkGraph and set its father.
+        If it exists (e.g. after a Reunion failure), it moves with its sub-tree under the new father.
 
         Warnings:
             1. Don't forget to set the new node as one of the father_address children.
@@ -116,11 +228,50 @@ class NetworkGraph:
 
         :return:
         """
-        father = self.find_node(father_address)
+        father = self.find_node(father_address[0], father_address[1])
         if father is not None:
-            node = GraphNode((ip, port))
+            address = NetworkGraph.parse_address((ip, port))
+            node = self.nodes.get(address)
+            if node is None:
+                node = GraphNode(address)
+                self.nodes[address] = node
+            elif node.parent is not None:
+                node.parent.children.remove(node)
+                self.__push_frontier(node.parent)
             node.alive = True
             node.set_parent(father)
             father.add_child(node)
-            self.nodes.append(node)
+            self.__update_depths(node)
         pass
+
+    def __update_depths(self, subtree_root):
+        """
+        Set the depth and path of every node in the sub-tree from its parent and add the candidates to the frontier.
+
+        :param subtree_root: Root of the sub-tree which has just got a new parent.
+        :type subtree_root: GraphNode
+
+        :return:
+        """
+        stack = [subtree_root]
+        while stack:
+            node = stack.pop()
+            node.depth = node.parent.depth + 1
+            node.path = node.parent.path + (node.parent,)
+            # Entries with the old depth are stale now.
+            node.frontier_entry = None
+            self.__push_frontier(node)
+            stack.extend(node.children)
+
+    @staticmethod
+    def parse_address(address):
+        """
+        Change the address to the standard format of our nodes, like ('192.168.001.001', '05335').
+
+        :param address: (ip, port)
+        :type address: tuple
+
+        :return: Formatted address
+        :rtype: tuple
+        """
+        return Node.parse_ip(address[0]), Node.parse_port(address[1])
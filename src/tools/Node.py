@@ -1,52 +1,275 @@
+import random
+import threading
+import time
+from collections import deque
+
 from src.tools.simpletcp.clientsocket import *
 
+# Types of the packets which are sent after the control packets (Message and Blob); the type is the 4th byte of a packet.
+BULK_PACKET_TYPES = frozenset((4, 6))
+
 
 class Node:
-    def __init__(self, server_address, set_root=False, set_register=False):
+    # Connection states, reported to on_state_change.
+    CONNECTED = 'connected'
+    DISCONNECTED = 'disconnected'  # reconnecting after a backoff delay
+    FAILED = 'failed'  # gave up reconnecting
+    CLOSED = 'closed'
+
+    # The delay before reconnect attempt n is a random part (50% to 100%) of min(MAX, BASE * 2 ** (n - 1)) seconds.
+    RECONNECT_BASE_DELAY = 0.1
+    RECONNECT_MAX_DELAY = 5.0
+    MAX_RECONNECT_ATTEMPTS = 8
+    # Most seconds one connect attempt may take; a peer which doesn't answer must not stall our sends for long.
+    CONNECT_TIMEOUT = 2.0
+    # Most messages kept while disconnected; the oldest bulk messages are dropped first.
+    DISCONNECTED_BUFFER_LIMIT = 1024
+
+    def __init__(self, server_address, set_root=False, set_register=False, pipelined=True, nodelay=True, cork=False,
+                 bulk_budget=64, on_state_change=None, on_writable=None):
         """
         The Node object constructor.
 
         This object is our low-level abstraction for other peers in the network.
         Every node has a ClientSocket that should bind to the Node TCPServer address.
 
-        Warnings:
-            1. Insert an exception handler when initializing the ClientSocket; when a socket closed here we will face to
-               an exception and we should detach this Node and clear its output buffer.
+        Connecting is done on a thread of its own, so a slow peer never stalls the thread which sends; the messages
+        stay in the buffers until it is done. When the connection fails or breaks, the node keeps (up to
+        DISCONNECTED_BUFFER_LIMIT of) its messages and 'send_message' starts reconnecting after an exponential, jittered
+        backoff; only after MAX_RECONNECT_ATTEMPTS failed attempts in a row does 'send_message' raise, so the owner can
+        detach this Node.
 
         :param server_address:
         :param set_root:
         :param set_register:
+        :param pipelined: Send without waiting for an ACK of every message; the Node TCPServer must not send ACKs.
+        :param nodelay: Set TCP_NODELAY, so a flush is sent at once instead of waiting for more data.
+        :param cork: Set TCP_CORK while flushing, so the kernel only sends full segments (Linux only).
+        :param bulk_budget: Maximum number of bulk packets (see BULK_PACKET_TYPES) to send in one 'send_message';
+                            None sends all of them. The control packets are always sent first, and all of them.
+        :param on_state_change: Called with (node, state) when the connection state changes, and after every failed
+                                connect attempt (then maybe with DISCONNECTED again).
+        :param on_writable: Called with (node) when bulk packets which were held back (see AsyncNode) have been sent
+                            outside 'send_message', so the owner can queue more of them.
         """
         # todo: check set_root and set_register flag
         self.is_registered = set_register
         self.is_root = set_root  # todo: just to be sure... check this later!
+        self.pipelined = pipelined
+        self.nodelay = nodelay
+        self.cork = cork
+        self.bulk_budget = bulk_budget
+        self.on_state_change = on_state_change
+        self.on_writable = on_writable
 
         self.server_ip = Node.parse_ip(server_address[0])
         self.server_port = Node.parse_port(server_address[1])
 
         print("Server Address: ", server_address)
 
+        # Control packets (Register, Advertise, Join, Reunion, ...) and bulk packets are kept apart, so heartbeats never
+        # wait behind a burst of broadcasts.
         self.out_buff = []
+        self.bulk_buff = deque()
+        # Bytes of the packets in bulk_buff, so the senders of blobs can keep them under a window.
+        self.bulk_bytes = 0
+        # Messages may be added from other threads (e.g. the workers of a Peer) while we send.
+        self._buff_lock = threading.Lock()
+        self.socket = None
+        self.state = None
+        self.error = None
+        # Failed connect attempts in a row, and when (time.monotonic) to try again.
+        self.reconnect_attempts = 0
+        self.next_reconnect = 0
+        # Messages dropped because the buffers were over the limit while disconnected.
+        self.dropped_messages = 0
+        # The thread of the connect attempt which is running, if any.
+        self._connect_thread = None
+        self.connect()
+        pass
+
+    def connect(self):
+        """
+        Start connecting our ClientSocket to the Node TCPServer address; the state changes to CONNECTED (or
+        DISCONNECTED) when it's done.
+
+        :return:
+        """
+        if self._connect_thread is not None:
+            return
+        self._connect_thread = threading.Thread(target=self.__connect, name='connect-' + self.server_port, daemon=True)
+        self._connect_thread.start()
+
+    def __connect(self):
         # todo: insert exception handler... done
         try:
-            self.socket = ClientSocket(self.server_ip, int(self.server_port), single_use=False)
+            sock = ClientSocket(self.server_ip, int(self.server_port), single_use=False, pipelined=self.pipelined,
+                                connect_timeout=self.CONNECT_TIMEOUT)
+            sock.set_nodelay(self.nodelay)
         except Exception as e:
             print(str(e))
             # todo: is this right?!... yes...fuck you!
-        pass
+            self.connection_failed(e)
+            self._connect_thread = None
+            # The owner may have looked at reconnect_delay while the attempt was running; report the state again now
+            # that the next attempt can be planned, even if it's DISCONNECTED like before.
+            if self.state == Node.DISCONNECTED:
+                self.set_state(Node.DISCONNECTED, force=True)
+            return
+        if self.state == Node.CLOSED:
+            sock.close()
+            self._connect_thread = None
+            return
+        self.socket = sock
+        self.reconnect_attempts = 0
+        self.error = None
+        self._connect_thread = None
+        self.set_state(Node.CONNECTED)
+
+    def connection_failed(self, error):
+        """
+        The connection could not be made or broke: plan the next attempt, or give up after too many of them.
+
+        :param error: What went wrong.
+        :type error: Exception
+
+        :return: Seconds until the next attempt, or None if we gave up.
+        :rtype: float
+        """
+        self.error = error
+        if self.state == Node.CLOSED:
+            return None
+        self.reconnect_attempts += 1
+        if self.reconnect_attempts > self.MAX_RECONNECT_ATTEMPTS:
+            self.set_state(Node.FAILED)
+            return None
+        delay = min(self.RECONNECT_MAX_DELAY, self.RECONNECT_BASE_DELAY * 2 ** (self.reconnect_attempts - 1))
+        delay *= random.uniform(0.5, 1.0)
+        self.next_reconnect = time.monotonic() + delay
+        self.set_state(Node.DISCONNECTED)
+        self.trim_buffers()
+        return delay
+
+    def set_state(self, state, force=False):
+        """
+        Change the connection state and report it.
+
+        :param state: Node.CONNECTED, Node.DISCONNECTED, Node.FAILED or Node.CLOSED
+        :param force: Report it even if the state is the same.
+
+        :return:
+        """
+        if state == self.state and not force:
+            return
+        self.state = state
+        if self.on_state_change is not None:
+            self.on_state_change(self, state)
+
+    def trim_buffers(self):
+        """
+        Drop the oldest messages over DISCONNECTED_BUFFER_LIMIT, bulk messages first.
+
+        :return:
+        """
+        with self._buff_lock:
+            extra = len(self.out_buff) + len(self.bulk_buff) - self.DISCONNECTED_BUFFER_LIMIT
+            while extra > 0 and self.bulk_buff:
+                self.bulk_bytes -= len(self.bulk_buff.popleft())
+                self.dropped_messages += 1
+                extra -= 1
+            if extra > 0:
+                del self.out_buff[:extra]
+                self.dropped_messages += extra
+
+    def requeue_messages(self, messages):
+        """
+        Put messages taken with take_out_messages back in front of the buffers, e.g. after a failed send.
+        Only the bulk packets are put back: a duplicate of them is dropped by its Message ID, but a duplicate control
+        packet (Register, Join, ...) would be handled twice; the control packets are dropped and counted instead.
+
+        :param messages: Messages in the order they were taken.
+
+        :return:
+        """
+        bulk = [message for message in messages if message[3] in BULK_PACKET_TYPES]
+        with self._buff_lock:
+            self.dropped_messages += len(messages) - len(bulk)
+            self.bulk_buff.extendleft(reversed(bulk))
+            self.bulk_bytes += sum(len(message) for message in bulk)
 
     def send_message(self):
         """
         Final function to send buffer to the client's socket.
 
+        In pipelined mode the whole buffer is written with one scatter/gather call (in most cases) and no copies.
+        While disconnected the messages stay in the buffers; once reconnecting is due it's tried here.
+
         :return:
         """
-        for message in self.out_buff:
-            self.socket.send(bytes(message))
-        # todo: should the out_buff be clear after sending?
-        self.out_buff.clear()
+        if self.socket is None and self.state == Node.DISCONNECTED and time.monotonic() >= self.next_reconnect:
+            self.connect()
+        if self.state == Node.FAILED:
+            raise ConnectionError('Gave up connecting to ' + str(self.get_server_address())) from self.error
+        if self.socket is None:
+            self.trim_buffers()
+            return
+        messages = self.take_out_messages()
+        try:
+            if self.pipelined:
+                if messages:
+                    self.socket.send_buffers(messages, cork=self.cork)
+                return
+            for message in messages:
+                self.socket.send(bytes(message))
+        except OSError as e:
+            # Some of them may have been sent already; a duplicate bulk packet is better than a loss (Message IDs drop
+            # them), while the control packets are sent again by their senders (Reunion) or are dropped.
+            self.requeue_messages(messages)
+            self.socket.close()
+            self.socket = None
+            self.connection_failed(e)
         pass
 
+    def reconnect_delay(self):
+        """
+
+        :return: Seconds until this node should try to reconnect, or None if it's not waiting to reconnect.
+        :rtype: float
+        """
+        if self.state != Node.DISCONNECTED or self._connect_thread is not None:
+            return None
+        return max(0.0, self.next_reconnect - time.monotonic())
+
+    def take_out_messages(self):
+        """
+        Take the messages to send in this flush: every control packet, then at most bulk_budget bulk packets.
+
+        :return: Messages in the order they should be sent.
+        :rtype: list
+        """
+        with self._buff_lock:
+            messages = self.out_buff
+            self.out_buff = []
+            bulk = self.bulk_buff
+            if self.bulk_budget is None or self.bulk_budget >= len(bulk):
+                messages.extend(bulk)
+                bulk.clear()
+                self.bulk_bytes = 0
+            else:
+                for _ in range(self.bulk_budget):
+                    message = bulk.popleft()
+                    self.bulk_bytes -= len(message)
+                    messages.append(message)
+        return messages
+
+    def has_pending_messages(self):
+        """
+
+        :return: Whether some messages were left for the next flush which can be sent now.
+        :rtype: bool
+        """
+        return self.state == Node.CONNECTED and bool(self.out_buff or self.bulk_buff)
+
     def add_message_to_out_buff(self, message):
         """
         Here we will add a new message to the server out_buff, then in 'send_message' will send them.
@@ -57,14 +280,21 @@ class Node:
         # todo: i don't know for sure if this'll work!
         if type(message) is not (bytearray or str):
             raise ValueError
-        self.out_buff.append(message)
+        with self._buff_lock:
+            if message[3] in BULK_PACKET_TYPES:
+                self.bulk_buff.append(message)
+                self.bulk_bytes += len(message)
+            else:
+                self.out_buff.append(message)
 
     def close(self):
         """
         Closing client's object.
         :return:
         """
-        self.socket.close()
+        self.set_state(Node.CLOSED)
+        if self.socket is not None:
+            self.socket.close()
 
     def get_server_address(self):
         """
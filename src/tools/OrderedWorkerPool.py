@@ -0,0 +1,86 @@
+import queue
+import threading
+import traceback
+
+
+class OrderedWorkerPool:
+    def __init__(self, workers, name='worker', capacity=None):
+        """
+        A pool of threads which runs tasks in parallel, but the tasks with the same key one by one and in the order
+        they were submitted: every key always goes to the same thread.
+
+        :param workers: Number of threads.
+        :param name: Prefix of the thread names.
+        :param capacity: Most tasks waiting for one thread; 'submit' blocks while the queue of the key is full, so a
+                         producer can't run ahead of the workers. None doesn't limit them.
+
+        :type workers: int
+        :type name: str
+        :type capacity: int
+        """
+        if workers < 1:
+            raise ValueError('A worker pool needs at least one worker')
+        self._queues = [queue.Queue(capacity or 0) for _ in range(workers)]
+        self._threads = []
+        for i, tasks in enumerate(self._queues):
+            thread = threading.Thread(target=self.__run, args=(tasks,), name=name + '-' + str(i), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, key, function, *args):
+        """
+        Run function(*args) on the thread of the key; it blocks while that thread has 'capacity' tasks waiting.
+
+        :param key: Any hashable key, e.g. the address of the packet source.
+        :param function: The task.
+
+        :return:
+        """
+        self._queues[hash(key) % len(self._queues)].put((function, args))
+
+    def join(self):
+        """
+        Block until every submitted task is done.
+
+        :return:
+        """
+        for tasks in self._queues:
+            tasks.join()
+
+    def close(self):
+        """
+        Let the threads finish the submitted tasks, then stop them.
+
+        :return:
+        """
+        for tasks in self._queues:
+            tasks.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def backlog(self):
+        """
+
+        :return: Number of submitted tasks which haven't started yet.
+        :rtype: int
+        """
+        return sum(tasks.qsize() for tasks in self._queues)
+
+    def __len__(self):
+        return len(self._queues)
+
+    @staticmethod
+    def __run(tasks):
+        while True:
+            task = tasks.get()
+            if task is None:
+                tasks.task_done()
+                return
+            function, args = task
+            try:
+                function(*args)
+            except Exception:
+                # One bad packet must not stop the worker.
+                traceback.print_exc()
+            finally:
+                tasks.task_done()
@@ -0,0 +1,88 @@
+import time
+from collections import OrderedDict
+
+
+class SeenCache:
+    def __init__(self, capacity=4096, ttl=60.0):
+        """
+        A bounded set of recently seen keys (e.g. broadcast message IDs).
+
+        Keys are forgotten ttl seconds after they were last seen, or earlier when more than capacity keys are stored
+        (the least recently seen goes first).
+
+        :param capacity: Maximum number of keys to remember.
+        :param ttl: Seconds to remember a key for.
+
+        :type capacity: int
+        :type ttl: float
+        """
+        self.capacity = capacity
+        self.ttl = ttl
+        # key -> expiry time; the least recently seen key is first.
+        self._expiries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def seen(self, key):
+        """
+        Check the key and remember it.
+
+        :param key: Any hashable key.
+
+        :return: Whether the key was seen before (and not forgotten yet).
+        :rtype: bool
+        """
+        now = time.monotonic()
+        expiries = self._expiries
+        # Every key has the same ttl, so the expired keys are all at the front.
+        while expiries:
+            oldest, expiry = next(iter(expiries.items()))
+            if expiry > now:
+                break
+            del expiries[oldest]
+            self.evictions += 1
+        was_seen = key in expiries
+        if was_seen:
+            self.hits += 1
+            expiries.move_to_end(key)
+        else:
+            self.misses += 1
+            if len(expiries) >= self.capacity:
+                expiries.popitem(last=False)
+                self.evictions += 1
+        expiries[key] = now + self.ttl
+        return was_seen
+
+    def __contains__(self, key):
+        """
+        Check the key without remembering it or counting a hit or miss.
+
+        :param key: Any hashable key.
+
+        :return: Whether the key was seen and is not forgotten yet.
+        :rtype: bool
+        """
+        expiry = self._expiries.get(key)
+        return expiry is not None and expiry > time.monotonic()
+
+    def hit_rate(self):
+        """
+
+        :return: The share of 'seen' calls which found their key.
+        :rtype: float
+        """
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self):
+        """
+
+        :return: Number of hits, misses, evictions and stored keys, and the hit rate.
+        :rtype: dict
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'size': len(self._expiries),
+                'hit_rate': self.hit_rate()}
+
+    def __len__(self):
+        return len(self._expiries)
@@ -1,9 +1,16 @@
+import os
 import sys
 import socket
 
 
 class ClientSocket:
-    def __init__(self, mode, port, received_bytes=2048, single_use=True):
+    # The most buffers one sendmsg() call accepts.
+    try:
+        IOV_MAX = os.sysconf('SC_IOV_MAX')
+    except (AttributeError, ValueError, OSError):
+        IOV_MAX = 1024
+
+    def __init__(self, mode, port, received_bytes=2048, single_use=True, pipelined=False, connect_timeout=None):
         """
 
         Handle the socket's mode.
@@ -12,6 +19,11 @@ class ClientSocket:
         localhost -> (127.0.0.1)
         public ->    (0.0.0.0)
         otherwise, mode is interpreted as an IP address.
+        If pipelined is True, send() does not wait for a response, so
+        many sends can be in flight at once; the server must not send
+        responses to such a socket.
+        connect_timeout is the most seconds connecting may take (None waits
+        as long as the system does); it doesn't apply to the sends.
         """
 
         if mode == "localhost":
@@ -31,15 +43,66 @@ class ClientSocket:
         self.received_bytes = received_bytes
         # Save whether this socket is single-use or not.
         self.single_use = single_use
+        # Save whether send() waits for a response or not.
+        self.pipelined = pipelined
         # If this isn't a single-use socket, connect right away.
         if not self.single_use:
-            self._socket.connect((self.connect_ip, self.connect_port))
+            self._socket.settimeout(connect_timeout)
+            try:
+                self._socket.connect((self.connect_ip, self.connect_port))
+            except OSError:
+                self._socket.close()
+                raise
+            self._socket.settimeout(None)
             # Keep track of whether this socket has been closed.
             self.closed = False
         # Keep track of whether this socket has been used, so we can
         # warn single-use sockets not to send data twice.
         self.used = False
 
+    def set_nodelay(self, enabled):
+        """
+
+        Turn Nagle's algorithm off (enabled=True) or on for this socket.
+
+        """
+        self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 if enabled else 0)
+
+    def send_buffers(self, buffers, cork=False):
+        """
+
+        Send a list of bytes-like objects back to back, with as few system
+        calls as possible and without joining them first (scatter/gather
+        with sendmsg). Partial writes are continued until everything is
+        sent. It never waits for a response, so use it only on pipelined
+        sockets.
+        If cork is True and the platform has TCP_CORK, the kernel holds
+        partial segments until all of the buffers are written.
+
+        """
+        if not hasattr(self._socket, 'sendmsg'):
+            # No scatter/gather here; one copy and one call instead.
+            self._socket.sendall(b"".join(buffers))
+            return
+        cork = cork and hasattr(socket, 'TCP_CORK')
+        if cork:
+            self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1)
+        try:
+            views = [memoryview(buffer) for buffer in buffers]
+            i = 0
+            while i < len(views):
+                sent = self._socket.sendmsg(views[i:i + self.IOV_MAX])
+                # Skip what was sent completely and cut what was sent partly.
+                while i < len(views) and sent >= len(views[i]):
+                    sent -= len(views[i])
+                    i += 1
+                if sent:
+                    views[i] = views[i][sent:]
+        finally:
+            if cork:
+                self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 0)
+        self.used = True
+
     def get_port(self):
         return self.connect_port
 
@@ -85,6 +148,11 @@ class ClientSocket:
             print("data must be a string or bytes", file=sys.stderr)
             raise ValueError
         # Everything is setup, now we must send the data.
+        if self.pipelined:
+            # Nobody will tell us how much was received, so send all of it.
+            self._socket.sendall(data)
+            self.used = True
+            return b""
         self._socket.send(data)
         # Keep track of the fact that we've sent data (or attempted to).
         self.used = True
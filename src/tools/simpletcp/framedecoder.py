@@ -0,0 +1,79 @@
+class FrameTooLarge(ValueError):
+    """
+    A frame is larger than the max_frame_size of its decoder; the connection
+    it came from should be closed.
+    """
+    pass
+
+
+class FrameDecoder:
+    def __init__(self, header_size, length_offset, length_size=4, max_frame_size=None):
+        """
+
+        Incremental decoder for length-prefixed frames.
+        TCP is a byte stream, so one recv() may hold several frames or only a
+        part of one. Every connection gets its own FrameDecoder; feed() it with
+        whatever was received and it returns the frames completed so far.
+        The frame length is read as a big-endian unsigned integer of
+        length_size bytes at length_offset and counts the bytes after the
+        header_size bytes of the header.
+        If the header size depends on the frame (e.g. on a version field),
+        header_size can be a function of (buffer, offset) instead; it is
+        called once the length field of the frame has been received.
+        With max_frame_size, feed() raises FrameTooLarge as soon as a header
+        announces a larger frame (header included), instead of buffering it.
+
+        """
+        self.header_size = header_size
+        self.length_offset = length_offset
+        self.length_end = length_offset + length_size
+        self.max_frame_size = max_frame_size
+        # Bytes needed before the header size and the length can be read.
+        self.min_header_size = self.length_end if callable(header_size) else header_size
+        # Bytes received but not yet returned as a complete frame.
+        self._buffer = bytearray()
+
+    def feed(self, data):
+        """
+
+        Add received data and return the list of frames (as bytes) which are
+        complete now, in the order they were received.
+
+        """
+        buf = self._buffer
+        buf += data
+        frames = []
+        ends = []
+        offset = 0
+        available = len(buf)
+        while available - offset >= self.min_header_size:
+            header_size = self.header_size
+            if callable(header_size):
+                header_size = header_size(buf, offset)
+            length = int.from_bytes(buf[offset + self.length_offset:offset + self.length_end], 'big')
+            if self.max_frame_size is not None and header_size + length > self.max_frame_size:
+                buf.clear()
+                raise FrameTooLarge('Frame of ' + str(header_size + length) + ' bytes is larger than '
+                                    + str(self.max_frame_size))
+            end = offset + header_size + length
+            if end > available:
+                break
+            offset = end
+            ends.append(end)
+        if ends:
+            # Copy every frame once, out of a view (slicing the bytearray would copy it twice).
+            with memoryview(buf) as view:
+                start = 0
+                for end in ends:
+                    frames.append(bytes(view[start:end]))
+                    start = end
+            del buf[:offset]
+        return frames
+
+    def pending(self):
+        """
+
+        Number of buffered bytes which do not make a complete frame yet.
+
+        """
+        return len(self._buffer)
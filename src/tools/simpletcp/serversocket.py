@@ -1,13 +1,18 @@
 import errno
 import queue
-import select
+import selectors
 import socket
 import sys
 
+from src.tools.simpletcp.framedecoder import FrameTooLarge
+
 
 class ServerSocket:
+    # Seconds between the checks of read_paused while reading is paused.
+    PAUSED_POLL_INTERVAL = 0.01
 
-    def __init__(self, mode, port, read_callback, max_connections, received_bytes):
+    def __init__(self, mode, port, read_callback, max_connections, received_bytes, frame_decoder=None,
+                 read_paused=None, reuse_port=False):
         """
         Handle the socket's mode.
         The socket's mode determines the IP address it binds to.
@@ -33,6 +38,12 @@ class ServerSocket:
         self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         # Make it non-blocking.
         self._socket.setblocking(0)
+        # Let several processes bind the same port; the kernel spreads the
+        # new connections over them.
+        if reuse_port:
+            if not hasattr(socket, 'SO_REUSEPORT'):
+                raise ValueError("SO_REUSEPORT is not supported on this platform")
+            self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         # Bind the socket, so it can listen.
         self._socket.bind((self.ip, self.port))
         # Save the callback
@@ -45,85 +56,172 @@ class ServerSocket:
         # Save the number of bytes to be received each time we read from
         # a socket
         self.received_bytes = received_bytes
+        # Save the frame decoder factory. If it is set, every connection gets
+        # its own decoder and the callback is called once per complete frame
+        # instead of once per recv().
+        self.frame_decoder = frame_decoder
+        # Save the backpressure check. While it returns True nothing is read
+        # from the sockets (so the senders slow down), but queued data is
+        # still written.
+        self.read_paused = read_paused
 
     def run(self):
         # Start listening
         self._socket.listen(self._max_connections)
-        # Create a list of readers (sockets that will be read from) and a list
-        # of writers (sockets that will be written to).
-        readers = [self._socket]
-        writers = []
+        # The selector picks the best mechanism of the platform (epoll on
+        # Linux), so a wakeup costs the same no matter how many sockets we
+        # hold and there is no FD_SETSIZE limit.
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self._socket, selectors.EVENT_READ)
         # Create a dictionary of queue.Queues for data to be sent.
         # This dictionary maps sockets to queue.Queue objects
-        queues = dict()
+        self._queues = dict()
         # Create a similar dictionary that stores IP addresses.
         # This dictionary maps sockets to IP addresses
-        IPs = dict()
+        self._IPs = dict()
+        # Create a dictionary that maps sockets to their frame decoders.
+        self._decoders = dict()
+        # Create a dictionary of bytes taken from a queue but not sent yet.
+        self._unsent = dict()
+        # Sockets which currently have write interest.
+        self._writers = set()
+        # Whether the client sockets currently have read interest.
+        self._reading = True
         # Now, the main loop.
-        while readers:
-            # Block until a socket is ready for processing.
-            read, write, err = select.select(readers, writers, readers)
-            # Deal with sockets that need to be read from.
-            for sock in read:
+        while True:
+            if self.read_paused is not None:
+                if self._reading == self.read_paused():
+                    self._set_reading(not self._reading)
+            # Block until a socket is ready for processing; while reading is
+            # paused wake up regularly to check if it can go on.
+            timeout = None if self._reading else self.PAUSED_POLL_INTERVAL
+            for key, events in self._selector.select(timeout):
+                sock = key.fileobj
                 if sock is self._socket:
-                    # We have a viable connection!
-                    client_socket, client_ip = self._socket.accept()
-                    # Make it a non-blocking connection.
-                    client_socket.setblocking(0)
-                    # Add it to our readers.
-                    readers.append(client_socket)
-                    # Make a queue for it.
-                    queues[client_socket] = queue.Queue()
-                    # Store its IP address.
-                    IPs[client_socket] = client_ip
-                else:
-                    # Someone sent us something! Let's receive it.
-                    try:
-                        data = sock.recv(self.received_bytes)
-                    except socket.error as e:
-                        if e.errno is errno.ECONNRESET:
-                            # Consider 'Connection reset by peer'
-                            # the same as reading zero bytes
-                            data = None
-                        else:
-                            raise e
-                    if data:
-                        # Call the callback
-                        self.callback(IPs[sock], queues[sock], data)
-                        # Put the client socket in writers so we can write to it
-                        # later.
-                        if sock not in writers:
-                            writers.append(sock)
+                    self._accept()
+                    continue
+                # Deal with sockets that need to be read from.
+                if events & selectors.EVENT_READ and self._reading:
+                    if self.read_paused is not None and self.read_paused():
+                        self._set_reading(False)
                     else:
-                        # We received zero bytes, so we should close the stream
-                        # Stop writing to it.
-                        if sock in writers:
-                            writers.remove(sock)
-                        # Stop reading from it.
-                        readers.remove(sock)
-                        # Close the connection.
-                        sock.close()
-                        # Destroy is queue
-                        del queues[sock]
-            # Deal with sockets that need to be written to.
-            for sock in write:
-                try:
-                    # Get the next chunk of data in the queue, but don't wait.
-                    data = queues[sock].get_nowait()
-                except queue.Empty:
-                    # The queue is empty -> nothing needs to be written.
-                    writers.remove(sock)
-                else:
-                    # The queue wasn't empty; we did, in fact, get something.
-                    # So send it.
-                    sock.send(data)
-            # Deal with errors in sockets.
-            for sock in err:
-                # Remove the socket from every list.
-                readers.remove(sock)
-                if sock in writers:
-                    writers.remove(sock)
-                # Close the connection.
-                sock.close()
-                # Destroy its queue.
-                del queues[sock]
+                        self._read(sock)
+                # Deal with sockets that need to be written to (and were not
+                # closed while reading).
+                if events & selectors.EVENT_WRITE and sock in self._writers:
+                    self._write(sock)
+
+    def _accept(self):
+        # Take every pending connection, not only one per wakeup.
+        while True:
+            try:
+                client_socket, client_ip = self._socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            # Make it a non-blocking connection.
+            client_socket.setblocking(0)
+            # Make a queue for it.
+            self._queues[client_socket] = queue.Queue()
+            # Store its IP address.
+            self._IPs[client_socket] = client_ip
+            # Give it its own frame decoder.
+            if self.frame_decoder is not None:
+                self._decoders[client_socket] = self.frame_decoder()
+            # Read from it (once reading is not paused).
+            self._update_interest(client_socket)
+
+    def _read(self, sock):
+        # Someone sent us something! Let's receive it.
+        try:
+            data = sock.recv(self.received_bytes)
+        except (BlockingIOError, InterruptedError):
+            return
+        except socket.error as e:
+            if e.errno == errno.ECONNRESET:
+                # Consider 'Connection reset by peer'
+                # the same as reading zero bytes
+                data = None
+            else:
+                raise e
+        if not data:
+            # We received zero bytes, so we should close the stream
+            self._close(sock)
+            return
+        # Call the callback
+        if self.frame_decoder is None:
+            self.callback(self._IPs[sock], self._queues[sock], data)
+        else:
+            # Once for every frame this chunk has completed.
+            try:
+                frames = self._decoders[sock].feed(data)
+            except FrameTooLarge:
+                # Don't buffer it; the sender is broken or hostile.
+                self._close(sock)
+                return
+            for frame in frames:
+                self.callback(self._IPs[sock], self._queues[sock], frame)
+        # Only ask for write events while there is something to write.
+        if sock not in self._writers and not self._queues[sock].empty():
+            self._writers.add(sock)
+            self._update_interest(sock)
+
+    def _write(self, sock):
+        data = self._unsent.pop(sock, b'')
+        # Take everything that is queued, so a burst costs one send().
+        chunks = [data]
+        while True:
+            try:
+                chunks.append(self._queues[sock].get_nowait())
+            except queue.Empty:
+                break
+        data = b''.join(chunks)
+        if data:
+            try:
+                sent = sock.send(data)
+            except (BlockingIOError, InterruptedError):
+                sent = 0
+            except socket.error:
+                self._close(sock)
+                return
+            if sent < len(data):
+                # Keep the rest for the next write event.
+                self._unsent[sock] = data[sent:]
+                return
+        # The queue is empty -> nothing needs to be written.
+        self._writers.discard(sock)
+        self._update_interest(sock)
+
+    def _set_reading(self, reading):
+        # Turn the read interest of every client socket on or off.
+        self._reading = reading
+        for sock in self._queues:
+            self._update_interest(sock)
+
+    def _update_interest(self, sock):
+        # Watch the socket for the events we currently care about; the
+        # selector can't hold a socket without events, so unregister it then.
+        events = 0
+        if self._reading:
+            events |= selectors.EVENT_READ
+        if sock in self._writers:
+            events |= selectors.EVENT_WRITE
+        registered = sock in self._selector.get_map()
+        if events and registered:
+            self._selector.modify(sock, events)
+        elif events:
+            self._selector.register(sock, events)
+        elif registered:
+            self._selector.unregister(sock)
+
+    def _close(self, sock):
+        # Stop watching it.
+        self._writers.discard(sock)
+        if sock in self._selector.get_map():
+            self._selector.unregister(sock)
+        # Close the connection.
+        sock.close()
+        # Destroy its queue, address, decoder and unsent data.
+        del self._queues[sock]
+        del self._IPs[sock]
+        self._decoders.pop(sock, None)
+        self._unsent.pop(sock, None)
@@ -17,12 +17,22 @@ class TCPServer:
      is a tunnel of data to send to the socket that it received from.
      The third argument must be data, which is a string of bytes
      that the server received.
+     frame_decoder optionally specifies a factory for per-connection frame
+     decoders (see framedecoder.FrameDecoder); with it, data is always one
+     complete frame no matter how TCP has split or joined the reads.
+     read_paused optionally specifies a function without arguments; while
+     it returns True the server stops reading (e.g. when the consumer of the
+     received data is behind), so the senders are slowed down by TCP.
+     reuse_port sets SO_REUSEPORT, so several servers (in different
+     processes) can listen on the same port and share its connections.
     """
 
     def __init__(self, mode, port, read_callback,
-                 maximum_connections=5, receive_bytes=2048):
+                 maximum_connections=5, receive_bytes=2048, frame_decoder=None,
+                 read_paused=None, reuse_port=False):
         self.server_socket = ServerSocket(
-            mode, port, read_callback, maximum_connections, receive_bytes
+            mode, port, read_callback, maximum_connections, receive_bytes,
+            frame_decoder, read_paused, reuse_port
         )
 
     def run(self):